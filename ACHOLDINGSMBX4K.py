@@ -7,26 +7,50 @@ import pygame
 import sys
 import os
 import math
+import mmap
 import struct
 import random
-from collections import deque
+import time
+import json
+import zlib
+import hashlib
+import cProfile
+import queue
+import threading
+import itertools
+from array import array
+from collections import deque, OrderedDict
+from collections.abc import Mapping
+try:
+    import numpy as np  # optional: batched walker physics
+except ImportError:
+    np = None
+from smbx_format import (
+    TILE_SMBX_IDS, BGO_SMBX_IDS, NPC_SMBX_IDS, TILE_ID_TO_NAME, BGO_ID_TO_NAME, NPC_ID_TO_NAME,
+    LevelFormatError, LVL_HEADER, LVL_HEADER_SIZE, U8, U32, SECTION_HEADER, BLOCK_RECORD,
+    BGO_RECORD, NPC_RECORD, WARP_RECORD_SIZE, EVENT_HEADER, EVENT_ACTION, MAX_LAYERS,
+    RawSection, SectionIndex, LvlReader, LevelInfo, parse_lvl_header, parse_section,
+    parse_events, encode_events, index_section, check_layer, read_raw_lvl)
 
 # ========================
 # INITIALIZATION
 # ========================
-pygame.init()
-pygame.mixer.init()
+# Importing this module touches no SDL subsystem: the window, fonts and the
+# mixer are brought up on first use (get_screen, get_font, play_sound), so
+# level tools and headless runs need no display or audio device.
 WINDOW_WIDTH, WINDOW_HEIGHT = 1024, 700
 GRID_SIZE = 32
 FPS = 60
-screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-pygame.display.set_caption("AC HOLDINGS CATSAN ENGINE SMBX 1.3")
+CHUNK_SIZE = 512          # pixel size of a pre-rendered static chunk
+MAX_CACHED_CHUNKS = 48    # per section, least recently drawn dropped first
+MAX_DAMAGE_RECTS = 64     # more rebakes than this between draws repaint everything
+ACTIVATION_MARGIN = 4 * GRID_SIZE  # NPCs wake this far outside the camera
+DORMANT_TIMEOUT = 3 * FPS          # ticks off screen before an NPC sleeps again
+screen = None  # the window surface, opened by get_screen()
 clock = pygame.time.Clock()
 
-# Fonts
-font = pygame.font.Font(None, 24)
-font_small = pygame.font.Font(None, 18)
-font_big = pygame.font.Font(None, 48)
+# Font sizes for get_font()
+FONT_SMALL, FONT_NORMAL, FONT_BIG = 18, 24, 48
 
 # Colors
 WHITE = (255,255,255)
@@ -44,6 +68,10 @@ MOVE_SPEED = 4
 TERMINAL_VELOCITY = 10
 FIREBALL_SPEED = 6
 
+# Every random decision the simulation makes goes through this generator, so
+# seeding it (see Replay) makes a run repeatable.
+rng = random.Random()
+
 # Asset paths
 SMBX_ASSETS = "smbx_assets"
 TILESET_DIR = os.path.join(SMBX_ASSETS, "tilesets")
@@ -52,39 +80,12 @@ NPC_GFX_DIR = os.path.join(SMBX_ASSETS, "npc")
 SOUND_DIR = os.path.join(SMBX_ASSETS, "sound")
 
 USE_GRAPHICS = os.path.isdir(SMBX_ASSETS)
-USE_SOUND = os.path.isdir(SOUND_DIR)
 
 # ========================
 # SMBX ID MAPPINGS (full)
 # ========================
-TILE_SMBX_IDS = {
-    'ground':1, 'grass':2, 'sand':3, 'dirt':4,
-    'brick':45, 'question':34, 'pipe_vertical':112, 'pipe_horizontal':113,
-    'platform':159, 'coin':10, 'bridge':47,
-    'stone':48, 'ice':55, 'mushroom_platform':91, 'pswitch':60,
-    'slope_left':182, 'slope_right':183, 'water':196, 'lava':197,
-    'conveyor_left':188, 'conveyor_right':189, 'semisolid':190,
-    'crate':191, 'switchblock':192, 'vine':193,
-}
-BGO_SMBX_IDS = {
-    'cloud':5, 'bush':6, 'hill':7, 'fence':8, 'bush_3':9, 'tree':10,
-    'castle':11, 'waterfall':12, 'sign':13, 'fence2':14, 'fence3':15,
-    'window':16, 'fence4':17, 'fence5':18,
-}
-NPC_SMBX_IDS = {
-    'goomba':1, 'koopa_green':2, 'koopa_red':3, 'paratroopa_green':4,
-    'paratroopa_red':5, 'piranha':6, 'hammer_bro':7, 'lakitu':8,
-    'mushroom':9, 'flower':10, 'star':11, '1up':12,
-    'buzzy':13, 'spiny':14, 'cheep':15, 'blooper':16, 'thwomp':17, 'bowser':18,
-    'boo':19, 'podoboo':20, 'piranha_fire':21, 'sledge_bro':22, 'rotodisc':23,
-    'burner':24, 'cannon':25, 'bullet_bill':26, 'bowser_statue':27,
-    'grinder':28, 'fishbone':29, 'dry_bones':30, 'boo_ring':31,
-    'bomber_bill':32, 'bony_beetle':33, 'skull_platform':34,
-    'birdo':35, 'egg':36, 'shell':37,
-}
-TILE_ID_TO_NAME = {v:k for k,v in TILE_SMBX_IDS.items()}
-BGO_ID_TO_NAME  = {v:k for k,v in BGO_SMBX_IDS.items()}
-NPC_ID_TO_NAME  = {v:k for k,v in NPC_SMBX_IDS.items()}
+# The ID tables and the LVL\x1a parsers live in smbx_format (imported above)
+# so they can be used without pygame.
 
 # Theme colors (fallback)
 themes = {
@@ -133,42 +134,572 @@ themes = {
 }
 current_theme = 'SMB1'
 
-def get_theme_color(name):
-    return themes[current_theme].get(name, (128,128,128))
+def get_theme_color(name, theme=None):
+    return themes[theme or current_theme].get(name, (128,128,128))
+
+def set_theme(name):
+    global current_theme
+    if name != current_theme:
+        current_theme = name
+        image_cache.retheme()
 
 # ========================
-# GRAPHICS LOADING (placeholder)
+# GRAPHICS AND SOUND LOADING
 # ========================
+# Real art fills these from the ASSET LOADER thread pool; render_*_art() falls
+# back to procedural placeholders for anything not (yet) loaded.
 tile_images = {}
 bgo_images = {}
 npc_images = {}
-sound_effects = {}
 
-def load_assets():
-    if USE_GRAPHICS:
-        # In a real implementation you'd load PNGs from the folders.
-        # For now, we'll just note that graphics are available.
-        pass
-    if USE_SOUND:
-        # Load sounds if they exist
-        for sound_file in ['coin.wav', 'jump.wav', 'powerup.wav', 'stomp.wav']:
-            path = os.path.join(SOUND_DIR, sound_file)
-            if os.path.exists(path):
-                sound_effects[sound_file[:-4]] = pygame.mixer.Sound(path)
+# Every effect the game plays, with its priority for the channel pool: when
+# all channels are busy a sound may take over the channel of the oldest
+# lower-or-equal priority one, otherwise it is dropped.
+SOUND_PRIORITIES = {
+    'die': 5, '1up': 4, 'powerup': 3, 'powerdown': 3, 'pipe': 3,
+    'jump': 2, 'stomp': 2, 'fireball': 1, 'coin': 1,
+}
+SOUND_CHANNELS = 16
+SOUND_EXTENSIONS = ('.wav', '.ogg')
+
+def init_mixer():
+    # False if there is no usable audio device; the game then runs silent.
+    if not pygame.mixer.get_init():
+        try:
+            pygame.mixer.init()
+        except pygame.error:
+            return False
+    return True
+
+class SoundManager:
+    # play() only records the request: a name that isn't loaded (missing file,
+    # still loading, no audio device, headless run) costs one dict lookup,
+    # and the same name requested several times before flush() plays once.
+    # The game loop calls flush() once per frame to start the queued sounds
+    # on a fixed pool of channels, most important first.
+    def __init__(self, channels=SOUND_CHANNELS):
+        self.num_channels = channels
+        self.sounds = {}     # name -> Sound, filled in by the loader thread
+        self.queued = set()
+        self.channels = []
+        self.owners = []     # per channel: (priority, order started)
+        self.order = itertools.count()
+        self.started = False
+
+    def start(self):
+        # Opens the mixer and preloads every effect in SOUND_PRIORITIES on a
+        # background thread. Does nothing without sound files.
+        if self.started:
+            return
+        self.started = True
+        paths = {}
+        for name in SOUND_PRIORITIES:
+            for ext in SOUND_EXTENSIONS:
+                path = os.path.join(SOUND_DIR, name + ext)
+                if os.path.exists(path):
+                    paths[name] = path
+                    break
+        if not paths or not init_mixer():
+            return
+        pygame.mixer.set_num_channels(self.num_channels)
+        self.channels = [pygame.mixer.Channel(i) for i in range(self.num_channels)]
+        self.owners = [(0, -1)] * self.num_channels
+        threading.Thread(target=self._load, args=(paths,), name="sound-loader", daemon=True).start()
+
+    def _load(self, paths):
+        for name, path in paths.items():
+            try:
+                self.sounds[name] = pygame.mixer.Sound(path)
+            except pygame.error:
+                pass  # unreadable file: that effect stays silent
+
+    def play(self, name):
+        if name in self.sounds:
+            self.queued.add(name)
+
+    def flush(self):
+        if not self.queued:
+            return
+        for name in sorted(self.queued, key=lambda n: -SOUND_PRIORITIES.get(n, 0)):
+            self._start(name, SOUND_PRIORITIES.get(name, 0))
+        self.queued.clear()
+
+    def _start(self, name, priority):
+        owners = self.owners
+        pick = None
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                pick = i
+                break
+            if owners[i][0] <= priority and (pick is None or owners[i] < owners[pick]):
+                pick = i
+        if pick is None:
+            return  # every channel busy with something more important
+        self.channels[pick].play(self.sounds[name])
+        owners[pick] = (priority, next(self.order))
 
-load_assets()
+sounds = SoundManager()
 
 def play_sound(name):
-    if name in sound_effects:
-        sound_effects[name].play()
+    sounds.play(name)
+
+def get_screen():
+    global screen
+    if screen is None:
+        pygame.display.init()
+        screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        pygame.display.set_caption("AC HOLDINGS CATSAN ENGINE SMBX 1.3")
+    return screen
 
 # ========================
 # HELPER FUNCTIONS
 # ========================
-def draw_text(surf, text, pos, color=WHITE, font=font, center=False):
-    img = font.render(text, True, color)
+fonts = {}  # size -> Font
+
+def get_font(size=FONT_NORMAL):
+    f = fonts.get(size)
+    if f is None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        f = fonts[size] = pygame.font.Font(None, size)
+    return f
+
+def draw_text(surf, text, pos, color=WHITE, font=None, center=False):
+    img = (font or get_font()).render(text, True, color)
     rect = img.get_rect(center=pos) if center else img.get_rect(topleft=pos)
-    surf.blit(img, rect)
+    return surf.blit(img, rect)
+
+# ========================
+# INPUT
+# ========================
+class InputState:
+    # Buttons the simulation reads in one tick. `up`/`down` are the raw
+    # directions used for warps; `jump`/`fire` are the mapped actions.
+    __slots__ = ('left', 'right', 'up', 'down', 'jump', 'fire')
+
+    def __init__(self, left=False, right=False, up=False, down=False, jump=False, fire=False):
+        self.left = left
+        self.right = right
+        self.up = up
+        self.down = down
+        self.jump = jump
+        self.fire = fire
+
+    @classmethod
+    def from_keys(cls, keys):
+        return cls(left=keys[pygame.K_LEFT] or keys[pygame.K_a],
+                   right=keys[pygame.K_RIGHT] or keys[pygame.K_d],
+                   up=keys[pygame.K_UP],
+                   down=keys[pygame.K_DOWN],
+                   jump=keys[pygame.K_SPACE] or keys[pygame.K_UP] or keys[pygame.K_w],
+                   fire=keys[pygame.K_s] or keys[pygame.K_DOWN])
+
+    def to_bits(self):
+        # One bit per button, in __slots__ order; what replays store per tick.
+        bits = 0
+        for i, name in enumerate(self.__slots__):
+            if getattr(self, name):
+                bits |= 1 << i
+        return bits
+
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(*[bool(bits >> i & 1) for i in range(len(cls.__slots__))])
+
+# Input sources hand the engine one InputState per tick through poll(tick).
+class KeyboardInput:
+    def poll(self, tick=0):
+        return InputState.from_keys(pygame.key.get_pressed())
+
+class ScriptedInput:
+    # Plays back a list of InputStates, then holds the last one (or idles).
+    def __init__(self, states):
+        self.states = list(states)
+        self.idle = InputState()
+
+    def poll(self, tick):
+        if tick < len(self.states):
+            return self.states[tick]
+        return self.states[-1] if self.states else self.idle
+
+class RandomInput:
+    # Seeded button mashing: a new random set of buttons is held for a random
+    # number of ticks. Leans right so runs make progress through the level.
+    def __init__(self, seed=0, hold=(5, 40)):
+        self.rng = random.Random(seed)
+        self.hold = hold
+        self.state = InputState()
+        self.until = 0
+
+    def poll(self, tick):
+        if tick >= self.until:
+            r = self.rng.random
+            left = r() < 0.2
+            self.state = InputState(left=left, right=not left and r() < 0.8,
+                                    up=r() < 0.05, down=r() < 0.1,
+                                    jump=r() < 0.4, fire=r() < 0.2)
+            self.until = tick + self.rng.randint(*self.hold)
+        return self.state
+
+# ========================
+# IMAGE CACHE
+# ========================
+def render_tile_art(tile_type, theme):
+    if USE_GRAPHICS and tile_type in tile_images:
+        return tile_images[tile_type]
+    image = pygame.Surface((GRID_SIZE, GRID_SIZE))
+    image.fill(get_theme_color(tile_type, theme))
+    if tile_type == 'question':
+        draw_text(image, '?', (GRID_SIZE//2, GRID_SIZE//2), BLACK, get_font(FONT_SMALL), True)
+    elif tile_type == 'brick':
+        pygame.draw.line(image, BLACK, (0, GRID_SIZE//2), (GRID_SIZE, GRID_SIZE//2), 2)
+        pygame.draw.line(image, BLACK, (GRID_SIZE//2, 0), (GRID_SIZE//2, GRID_SIZE), 2)
+    elif tile_type == 'coin':
+        pygame.draw.circle(image, YELLOW, (GRID_SIZE//2, GRID_SIZE//2), GRID_SIZE//3)
+    elif tile_type == 'pipe_vertical':
+        pygame.draw.rect(image, (0,160,0), (4,0, GRID_SIZE-8, GRID_SIZE))
+        pygame.draw.rect(image, (0,200,0), (2,0, GRID_SIZE-4, 8))
+    elif tile_type == 'pipe_horizontal':
+        pygame.draw.rect(image, (0,160,0), (0,4, GRID_SIZE, GRID_SIZE-8))
+        pygame.draw.rect(image, (0,200,0), (0,2, 8, GRID_SIZE-4))
+    elif tile_type == 'slope_left':
+        pygame.draw.polygon(image, get_theme_color(tile_type, theme),
+                            [(0,0), (GRID_SIZE,0), (0,GRID_SIZE)])
+    elif tile_type == 'slope_right':
+        pygame.draw.polygon(image, get_theme_color(tile_type, theme),
+                            [(0,0), (GRID_SIZE,0), (GRID_SIZE,GRID_SIZE)])
+    elif tile_type == 'water':
+        image.fill((0,100,255,128), special_flags=pygame.BLEND_ALPHA_SDL2)
+    elif tile_type == 'lava':
+        image.fill((255,80,0,128), special_flags=pygame.BLEND_ALPHA_SDL2)
+    pygame.draw.rect(image, (0,0,0,60), image.get_rect(), 1)
+    return image
+
+def render_bgo_art(bgo_type, theme):
+    if USE_GRAPHICS and bgo_type in bgo_images:
+        return bgo_images[bgo_type]
+    image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
+    color = get_theme_color(bgo_type if bgo_type.startswith('bgo_') else 'bgo_'+bgo_type, theme)
+    pygame.draw.rect(image, color, image.get_rect().inflate(-4,-4))
+    pygame.draw.rect(image, (*color[:3],180), image.get_rect(), 2)
+    return image
+
+def render_npc_art(npc_type, state, theme):
+    if USE_GRAPHICS and npc_type in npc_images:
+        return npc_images[npc_type]
+    image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
+    color = get_theme_color(npc_type, theme)
+    if npc_type == 'goomba':
+        pygame.draw.ellipse(image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
+        pygame.draw.rect(image, color, (0, GRID_SIZE-8, GRID_SIZE, 8))
+    elif npc_type.startswith('koopa') or npc_type == 'buzzy':
+        pygame.draw.rect(image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
+        if state == 'shell':
+            image.fill((200,200,0))
+    elif npc_type == 'piranha':
+        pygame.draw.rect(image, color, (8,8, GRID_SIZE-16, GRID_SIZE-8))
+        pygame.draw.circle(image, (255,255,255), (GRID_SIZE//2, 12), 4)
+    elif npc_type == 'thwomp':
+        pygame.draw.rect(image, (100,100,100), (0,0, GRID_SIZE, GRID_SIZE))
+        pygame.draw.rect(image, (50,50,50), (4,4, GRID_SIZE-8, GRID_SIZE-8))
+    elif npc_type == 'lakitu':
+        pygame.draw.rect(image, (100,200,100), (4,4, GRID_SIZE-8, GRID_SIZE-4))
+        pygame.draw.circle(image, WHITE, (GRID_SIZE//2, 8), 4)
+    elif npc_type == 'boo':
+        pygame.draw.rect(image, (255,200,200), (4,4, GRID_SIZE-8, GRID_SIZE-4))
+        pygame.draw.circle(image, BLACK, (10,12), 2)
+        pygame.draw.circle(image, BLACK, (22,12), 2)
+    else:
+        pygame.draw.rect(image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
+    return image
+
+def render_fireball_art(_type, theme):
+    image = pygame.Surface((16,16))
+    image.fill(YELLOW)
+    return image
+
+ART_RENDERERS = {
+    'tile': lambda t, state, theme: render_tile_art(t, theme),
+    'bgo': lambda t, state, theme: render_bgo_art(t, theme),
+    'npc': render_npc_art,
+    'fireball': lambda t, state, theme: render_fireball_art(t, theme),
+}
+
+class ImageCache:
+    # Flyweight images for tiles, BGOs and NPCs. Every object of the same
+    # (kind, type, state) holds the same Surface from `shared`. Rendered art is
+    # kept per (theme, kind, type, state); on a theme change each shared
+    # surface is repainted in place from the new theme's art, so objects keep
+    # their reference and the work is once per type rather than per object.
+    def __init__(self):
+        self.art = {}     # (theme, kind, type, state) -> Surface
+        self.shared = {}  # (kind, type, state) -> Surface handed out to objects
+        self.generation = 0  # bumped whenever shared surfaces are repainted
+
+    def get(self, kind, obj_type, state=None):
+        key = (kind, obj_type, state)
+        surf = self.shared.get(key)
+        if surf is None:
+            art = self._art(current_theme, key)
+            # Always per-pixel alpha, so art loaded later with transparency
+            # can be painted into it.
+            surf = pygame.Surface(art.get_size(), pygame.SRCALPHA)
+            if pygame.display.get_surface() is not None:
+                surf = surf.convert_alpha()
+            self._paint(surf, art)
+            self.shared[key] = surf
+        return surf
+
+    def retheme(self):
+        for key, surf in self.shared.items():
+            self._paint(surf, self._art(current_theme, key))
+        self.generation += 1
+
+    def refresh(self, kind, obj_type):
+        # Real art for one type has arrived (see AssetLoader): forget what was
+        # rendered for it and repaint its shared surfaces in place.
+        for full_key in [k for k in self.art if k[1] == kind and k[2] == obj_type]:
+            del self.art[full_key]
+        for key, surf in self.shared.items():
+            if key[0] == kind and key[1] == obj_type:
+                self._paint(surf, self._art(current_theme, key))
+        self.generation += 1
+
+    def _paint(self, surf, art):
+        surf.fill((0,0,0,0))
+        # Adding onto a cleared surface copies pixels and alpha exactly.
+        surf.blit(art, (0,0), special_flags=pygame.BLEND_RGBA_ADD)
+
+    def _art(self, theme, key):
+        full_key = (theme,) + key
+        art = self.art.get(full_key)
+        if art is None:
+            kind, obj_type, state = key
+            art = ART_RENDERERS[kind](obj_type, state, theme)
+            if pygame.display.get_surface() is not None:
+                art = art.convert_alpha() if art.get_flags() & pygame.SRCALPHA else art.convert()
+            self.art[full_key] = art
+        return art
+
+image_cache = ImageCache()
+
+# ========================
+# ASSET LOADER
+# ========================
+# Real graphics from smbx_assets/, named as in SMBX: block-<id>.png in
+# TILESET_DIR, background-<id>.png (BGOs) in BACKGROUND_DIR and npc-<id>.png
+# in NPC_GFX_DIR. Worker threads decode the PNGs into RGBA bytes, cut to one
+# GRID_SIZE frame, and keep those bytes in ASSET_CACHE_DIR so the next run
+# skips decoding. The main thread makes display-format surfaces from them in
+# pump() and repaints the procedural placeholders already handed out, so the
+# game starts at once and real art appears as it lands.
+ASSET_SOURCES = {
+    'tile': (TILESET_DIR, 'block-{}.png', TILE_SMBX_IDS, tile_images),
+    'bgo': (BACKGROUND_DIR, 'background-{}.png', BGO_SMBX_IDS, bgo_images),
+    'npc': (NPC_GFX_DIR, 'npc-{}.png', NPC_SMBX_IDS, npc_images),
+}
+ASSET_CACHE_DIR = os.path.join(SMBX_ASSETS, '.pixels')
+ASSET_WORKERS = 4
+ASSET_PUMP_LIMIT = 256             # surfaces made per frame at most
+PRIORITY_SECTION, PRIORITY_REST = 0, 1
+PIXELS_HEADER = struct.Struct('<4sQqII')  # magic, source size, source mtime_ns, width, height
+PIXELS_MAGIC = b'RGBA'
+
+def load_pixels(kind, path):
+    # (width, height, RGBA bytes) of one asset, from the pixel cache when it
+    # matches the source's size and mtime. Raises OSError or pygame.error.
+    stat = os.stat(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache = os.path.join(ASSET_CACHE_DIR, name + '.rgba')
+    try:
+        with open(cache, 'rb') as f:
+            data = f.read()
+        magic, size, mtime, w, h = PIXELS_HEADER.unpack_from(data)
+        if ((magic, size, mtime, w, h) == (PIXELS_MAGIC, stat.st_size, stat.st_mtime_ns,
+                                            GRID_SIZE, GRID_SIZE)
+                and len(data) == PIXELS_HEADER.size + w * h * 4):
+            return w, h, data[PIXELS_HEADER.size:]
+    except (OSError, struct.error):
+        pass
+    image = pygame.image.load(path)
+    w, h = image.get_size()
+    if kind == 'npc' and h > w:
+        image = image.subsurface((0, 0, w, w))  # first frame of the sheet
+    if image.get_size() != (GRID_SIZE, GRID_SIZE):
+        image = pygame.transform.scale(image, (GRID_SIZE, GRID_SIZE))
+    pixels = pygame.image.tostring(image, 'RGBA')
+    try:
+        os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+        tmp = f"{cache}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(PIXELS_HEADER.pack(PIXELS_MAGIC, stat.st_size, stat.st_mtime_ns,
+                                       GRID_SIZE, GRID_SIZE))
+            f.write(pixels)
+        os.replace(tmp, cache)
+    except OSError:
+        pass  # read-only asset folder: decode again next time
+    return GRID_SIZE, GRID_SIZE, pixels
+
+class AssetLoader:
+    def __init__(self, workers=ASSET_WORKERS):
+        self.workers = workers
+        self.threads = []
+        self.jobs = queue.PriorityQueue()  # (priority, seq, kind, type, path)
+        self.results = queue.SimpleQueue()
+        self.queued = {}    # (kind, type) -> best priority queued so far
+        self.taken = set()  # (kind, type) a worker has started on
+        self.finished = 0   # results pumped, loaded or not
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+
+    def start(self):
+        # Nothing is loaded without an asset folder, or until something asks
+        # for real art (run(), the menu); headless runs never start threads.
+        if self.threads or not USE_GRAPHICS:
+            return
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, name="asset-loader", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def request(self, kind, obj_type, priority=PRIORITY_REST):
+        # Asking again with a better priority queues it again, ahead; the
+        # stale entry is skipped when a worker reaches it.
+        key = (kind, obj_type)
+        if not self.threads or self.queued.get(key, priority + 1) <= priority:
+            return
+        directory, pattern, ids, _ = ASSET_SOURCES[kind]
+        smbx_id = ids.get(obj_type)
+        if smbx_id is None:
+            return  # no SMBX art for it; drawn with the placeholder
+        self.queued[key] = priority
+        path = os.path.join(directory, pattern.format(smbx_id))
+        self.jobs.put((priority, next(self.seq), kind, obj_type, path))
+
+    def request_section(self, section):
+        for layer in section.layers:
+            for type_id in set(layer.tiles.types):
+                self.request('tile', TILE_ID_TO_NAME[type_id], PRIORITY_SECTION)
+            for bgo in layer.bgos:
+                self.request('bgo', bgo.bgo_type, PRIORITY_SECTION)
+            for npc in layer.npcs:
+                self.request('npc', npc.npc_type, PRIORITY_SECTION)
+
+    def request_all(self):
+        for kind, (_, _, ids, _) in ASSET_SOURCES.items():
+            for name in ids:
+                self.request(kind, name)
+
+    def pending(self):
+        return len(self.queued) - self.finished
+
+    def _work(self):
+        while True:
+            _, _, kind, obj_type, path = self.jobs.get()
+            with self.lock:
+                if (kind, obj_type) in self.taken:
+                    continue
+                self.taken.add((kind, obj_type))
+            try:
+                pixels = load_pixels(kind, path)
+            except (OSError, pygame.error):
+                pixels = None  # no such file, or not an image: keep the placeholder
+            self.results.put((kind, obj_type, pixels))
+
+    def pump(self, limit=ASSET_PUMP_LIMIT):
+        # Main thread only: surfaces are created and converted here.
+        done = 0
+        while done < limit:
+            try:
+                kind, obj_type, pixels = self.results.get_nowait()
+            except queue.Empty:
+                break
+            done += 1
+            self.finished += 1
+            if pixels is None:
+                continue
+            w, h, data = pixels
+            image = pygame.image.fromstring(data, (w, h), 'RGBA')
+            if pygame.display.get_surface() is not None:
+                image = image.convert_alpha()
+            ASSET_SOURCES[kind][3][obj_type] = image
+            image_cache.refresh(kind, obj_type)
+        return done
+
+    def wait(self, timeout=None):
+        # Pump until every queued asset has arrived (tools, tests).
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.pending():
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            if not self.pump():
+                time.sleep(0.001)
+        return True
+
+assets = AssetLoader()
+
+# ========================
+# PARALLAX BACKGROUNDS
+# ========================
+# Section.background_image names SMBX backgrounds (background2-<id>.png in
+# BACKGROUND_DIR): one id, or up to len(PARALLAX_FACTORS) ids listed
+# farthest first. Each image is loaded once, scaled to the window height and
+# tiled into a strip one window wider than the image, so any scroll offset
+# is a single area blit per layer. Strips are shared by image id across
+# sections and kept for the session.
+BACKGROUND_PATTERN = 'background2-{}.png'
+PARALLAX_FACTORS = (0.5, 0.7, 0.85)  # share of the camera scroll, far to near
+
+class BackgroundRenderer:
+    def __init__(self):
+        self.strips = {}  # image id -> (Surface, period), or None if missing
+
+    def layers(self, section):
+        ids = section.background_image
+        if ids is None:
+            return []
+        if isinstance(ids, int):
+            ids = (ids,)
+        layers = []
+        for image_id, factor in zip(ids, PARALLAX_FACTORS):
+            strip = self.strip(image_id)
+            if strip is not None:
+                layers.append((strip, factor))
+        return layers
+
+    def strip(self, image_id):
+        if image_id in self.strips:
+            return self.strips[image_id]
+        strip = None
+        path = os.path.join(BACKGROUND_DIR, BACKGROUND_PATTERN.format(image_id))
+        try:
+            image = pygame.image.load(path)
+        except (OSError, pygame.error):
+            image = None
+        if image is not None:
+            w, h = image.get_size()
+            period = max(1, w * WINDOW_HEIGHT // h)
+            image = pygame.transform.scale(image, (period, WINDOW_HEIGHT))
+            surf = pygame.Surface((period * (WINDOW_WIDTH // period + 2), WINDOW_HEIGHT),
+                                  pygame.SRCALPHA)
+            for x in range(0, surf.get_width(), period):
+                surf.blit(image, (x, 0))
+            if pygame.display.get_surface() is not None:
+                surf = surf.convert_alpha()
+            strip = (surf, period)
+        self.strips[image_id] = strip
+        return strip
+
+    def draw(self, surf, section, view, area=None):
+        # Paints the background over `area` (a screen rect, default all of
+        # it): the section colour, then each layer as one blit.
+        area = area or surf.get_rect()
+        surf.fill(section.bg_color, area)
+        for (strip, period), factor in self.layers(section):
+            x = int(view.x * factor) % period
+            surf.blit(strip, area.topleft, (x + area.x, area.y, area.w, area.h))
+
+backgrounds = BackgroundRenderer()
 
 # ========================
 # GAME OBJECT CLASSES
@@ -181,57 +712,92 @@ class GameObject(pygame.sprite.Sprite):
         self.obj_type = obj_type
         self.event_id = event_id
         self.flags = flags
+        self.home_layer = None  # Layer object, set when added to one
+
+class Tile:
+    # Handle onto one TileStore row. Interactive tiles (question, brick,
+    # pswitch, coin) keep one handle for life, since their bump state lives
+    # here; static tiles are just columns and only get short-lived handles when
+    # collision or tile_map lookups ask for one. Tile(...) builds a detached
+    # tile that Layer.add_tile() copies into the layer's store.
+    __slots__ = ('store', 'row', 'rect', 'contents', 'bumped', 'bump_timer')
 
-class Tile(GameObject):
     def __init__(self, x, y, tile_type, layer=0, event_id=-1, flags=0):
-        super().__init__(x, y, tile_type, layer, event_id, flags)
-        self.tile_type = tile_type
-        self.is_solid = self._is_solid()
+        store = TileStore()
+        self._bind(store, store.append(x, y, TILE_SMBX_IDS[tile_type], event_id, flags))
         self.contents = None  # for question blocks, etc.
         self.bumped = False
         self.bump_timer = 0
-        self.update_image()
 
-    def _is_solid(self):
-        non_solid = ['coin', 'water', 'lava', 'vine']
-        return self.tile_type not in non_solid
+    @classmethod
+    def for_row(cls, store, row):
+        tile = cls.__new__(cls)
+        tile._bind(store, row)
+        tile.contents = None
+        tile.bumped = False
+        tile.bump_timer = 0
+        return tile
+
+    def _bind(self, store, row):
+        self.store = store
+        self.row = row
+        self.rect = pygame.Rect(store.xs[row], store.ys[row], GRID_SIZE, GRID_SIZE)
+
+    @property
+    def tile_type(self):
+        return TILE_ID_TO_NAME[self.store.types[self.row]]
+
+    @tile_type.setter
+    def tile_type(self, name):
+        self.store.set_type(self.row, TILE_SMBX_IDS[name])
+
+    obj_type = tile_type
+
+    @property
+    def is_solid(self):
+        return bool(self.store.state[self.row] & TILE_SOLID)
+
+    @property
+    def image(self):
+        return image_cache.get('tile', self.tile_type)
+
+    @property
+    def home_layer(self):
+        return self.store.layer
+
+    @property
+    def layer(self):
+        return self.store.layer.index if self.store.layer else 0
+
+    @property
+    def event_id(self):
+        return self.store.events[self.row]
+
+    @property
+    def flags(self):
+        return self.store.flags[self.row]
+
+    def alive(self):
+        return self.store.layer is not None and bool(self.store.state[self.row] & TILE_ALIVE)
+
+    def kill(self):
+        self.store.remove_row(self.row)
 
     def update_image(self):
-        if USE_GRAPHICS and self.tile_type in tile_images:
-            self.image = tile_images[self.tile_type]
-        else:
-            self.image = pygame.Surface((GRID_SIZE, GRID_SIZE))
-            self.image.fill(get_theme_color(self.tile_type))
-            if self.tile_type == 'question':
-                draw_text(self.image, '?', (GRID_SIZE//2, GRID_SIZE//2), BLACK, font_small, True)
-            elif self.tile_type == 'brick':
-                pygame.draw.line(self.image, BLACK, (0, GRID_SIZE//2), (GRID_SIZE, GRID_SIZE//2), 2)
-                pygame.draw.line(self.image, BLACK, (GRID_SIZE//2, 0), (GRID_SIZE//2, GRID_SIZE), 2)
-            elif self.tile_type == 'coin':
-                pygame.draw.circle(self.image, YELLOW, (GRID_SIZE//2, GRID_SIZE//2), GRID_SIZE//3)
-            elif self.tile_type == 'pipe_vertical':
-                pygame.draw.rect(self.image, (0,160,0), (4,0, GRID_SIZE-8, GRID_SIZE))
-                pygame.draw.rect(self.image, (0,200,0), (2,0, GRID_SIZE-4, 8))
-            elif self.tile_type == 'pipe_horizontal':
-                pygame.draw.rect(self.image, (0,160,0), (0,4, GRID_SIZE, GRID_SIZE-8))
-                pygame.draw.rect(self.image, (0,200,0), (0,2, 8, GRID_SIZE-4))
-            elif self.tile_type == 'slope_left':
-                pygame.draw.polygon(self.image, get_theme_color(self.tile_type),
-                                    [(0,0), (GRID_SIZE,0), (0,GRID_SIZE)])
-            elif self.tile_type == 'slope_right':
-                pygame.draw.polygon(self.image, get_theme_color(self.tile_type),
-                                    [(0,0), (GRID_SIZE,0), (GRID_SIZE,GRID_SIZE)])
-            elif self.tile_type == 'water':
-                self.image.fill((0,100,255,128), special_flags=pygame.BLEND_ALPHA_SDL2)
-            elif self.tile_type == 'lava':
-                self.image.fill((255,80,0,128), special_flags=pygame.BLEND_ALPHA_SDL2)
-            pygame.draw.rect(self.image, (0,0,0,60), self.image.get_rect(), 1)
+        # The image is looked up by type; only the chunk needs rebaking.
+        self.redraw()
+
+    def redraw(self):
+        # Tiles are drawn from pre-rendered chunks; ask for ours to be rebaked.
+        if self.home_layer and self.home_layer.section:
+            self.home_layer.section.chunks.invalidate_rect(self.rect)
 
     def bump(self, player):
         if self.bumped:
             return
         self.bumped = True
         self.bump_timer = 10
+        self.redraw()
         if self.tile_type == 'question':
             # Spawn item
             if self.contents:
@@ -246,7 +812,9 @@ class Tile(GameObject):
                     npc = NPC(self.rect.x, self.rect.y-32, '1up', layer=self.layer)
                 else:
                     npc = NPC(self.rect.x, self.rect.y-32, 'coin', layer=self.layer)
-                self.groups()[0].add(npc)  # add to same layer group
+                npc.spawn = None  # items don't respawn once gone
+                layer = self.home_layer
+                layer.section.npc_registry.spawn(npc, layer)  # same layer, end of tick
             self.tile_type = 'brick'  # becomes brick after hit
             self.update_image()
         elif self.tile_type == 'brick' and player.powerup_state > 0:
@@ -264,13 +832,7 @@ class BGO(GameObject):
         self.update_image()
 
     def update_image(self):
-        if USE_GRAPHICS and self.bgo_type in bgo_images:
-            self.image = bgo_images[self.bgo_type]
-        else:
-            self.image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
-            color = get_theme_color('bgo_'+self.bgo_type) if not self.bgo_type.startswith('bgo_') else get_theme_color(self.bgo_type)
-            pygame.draw.rect(self.image, color, self.image.get_rect().inflate(-4,-4))
-            pygame.draw.rect(self.image, (*color[:3],180), self.image.get_rect(), 2)
+        self.image = image_cache.get('bgo', self.bgo_type)
 
 class Fireball(pygame.sprite.Sprite):
     def __init__(self, x, y, direction, layer):
@@ -278,19 +840,18 @@ class Fireball(pygame.sprite.Sprite):
         self.rect = pygame.Rect(x, y, 16, 16)
         self.direction = direction
         self.velocity = pygame.Vector2(direction * FIREBALL_SPEED, -4)
-        self.image = pygame.Surface((16,16))
-        self.image.fill(YELLOW)
+        self.image = image_cache.get('fireball', 'fireball')
         self.layer = layer
         self.bounces = 0
 
-    def update(self, solid_tiles, npcs, player):
+    def update(self, solid_tiles, actors, player):
         self.rect.x += self.velocity.x
         self._collide(solid_tiles, 'x')
         self.rect.y += self.velocity.y
         self.velocity.y += GRAVITY * 0.5
         self._collide(solid_tiles, 'y')
         # Check collision with NPCs
-        for npc in npcs:
+        for npc in actors.query(self.rect):
             if self.rect.colliderect(npc.rect) and not npc.dead:
                 npc.dead = True
                 npc.death_timer = 10
@@ -298,7 +859,7 @@ class Fireball(pygame.sprite.Sprite):
                 break
 
     def _collide(self, tiles, axis):
-        for t in tiles:
+        for t in tiles.near(self.rect):
             if not self.rect.colliderect(t.rect):
                 continue
             if axis == 'x':
@@ -330,6 +891,24 @@ class NPC(GameObject):
         self.death_timer = 0
         self.in_shell = False
         self.shell_speed = 0
+        self.spawn = (x, y, direction)  # None for NPCs spawned during play
+        self.npc_id = None  # assigned by the section's NPCRegistry
+        self.slot = None
+        self.update_image()
+
+    def respawn(self):
+        # Back to how the level placed it, ready for when it wakes up again.
+        x, y, direction = self.spawn
+        self.rect.topleft = (x, y)
+        self.direction = direction
+        self.velocity.update(direction * self._base_speed(), 0)
+        self.state = 'normal'
+        self.frame = 0
+        self.on_ground = False
+        self.dead = False
+        self.death_timer = 0
+        self.in_shell = False
+        self.shell_speed = 0
         self.update_image()
 
     def _base_speed(self):
@@ -343,40 +922,11 @@ class NPC(GameObject):
         return speeds.get(self.npc_type, 1)
 
     def update_image(self):
-        if USE_GRAPHICS and self.npc_type in npc_images:
-            self.image = npc_images[self.npc_type]
-        else:
-            self.image = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
-            color = get_theme_color(self.npc_type)
-            if self.npc_type == 'goomba':
-                pygame.draw.ellipse(self.image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
-                pygame.draw.rect(self.image, color, (0, GRID_SIZE-8, GRID_SIZE, 8))
-            elif self.npc_type.startswith('koopa') or self.npc_type == 'buzzy':
-                pygame.draw.rect(self.image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
-                if self.state == 'shell':
-                    self.image.fill((200,200,0))
-            elif self.npc_type == 'piranha':
-                pygame.draw.rect(self.image, color, (8,8, GRID_SIZE-16, GRID_SIZE-8))
-                pygame.draw.circle(self.image, (255,255,255), (GRID_SIZE//2, 12), 4)
-            elif self.npc_type == 'thwomp':
-                pygame.draw.rect(self.image, (100,100,100), (0,0, GRID_SIZE, GRID_SIZE))
-                pygame.draw.rect(self.image, (50,50,50), (4,4, GRID_SIZE-8, GRID_SIZE-8))
-            elif self.npc_type == 'lakitu':
-                pygame.draw.rect(self.image, (100,200,100), (4,4, GRID_SIZE-8, GRID_SIZE-4))
-                pygame.draw.circle(self.image, WHITE, (GRID_SIZE//2, 8), 4)
-            elif self.npc_type == 'boo':
-                pygame.draw.rect(self.image, (255,200,200), (4,4, GRID_SIZE-8, GRID_SIZE-4))
-                pygame.draw.circle(self.image, BLACK, (10,12), 2)
-                pygame.draw.circle(self.image, BLACK, (22,12), 2)
-            else:
-                pygame.draw.rect(self.image, color, (4,4, GRID_SIZE-8, GRID_SIZE-4))
+        self.image = image_cache.get('npc', self.npc_type, self.state)
 
     def update(self, solid_tiles, player, fireballs, events):
         if self.dead:
-            self.death_timer -= 1
-            if self.death_timer <= 0:
-                self.kill()
-            return
+            return  # NPCRegistry.flush() counts down death_timer
 
         # Handle shell state
         if self.state == 'shell':
@@ -403,7 +953,7 @@ class NPC(GameObject):
         if self.npc_type == 'goomba':
             pass
         elif self.npc_type == 'koopa_green' or self.npc_type == 'koopa_red':
-            if self.on_ground and random.random() < 0.01:
+            if self.on_ground and rng.random() < 0.01:
                 self.velocity.x *= -1
                 self.direction *= -1
         elif self.npc_type == 'paratroopa_green':
@@ -418,10 +968,11 @@ class NPC(GameObject):
             pass
         elif self.npc_type == 'lakitu':
             # Throw spinies
-            if random.random() < 0.005:
+            if rng.random() < 0.005:
                 spiny = NPC(self.rect.x, self.rect.y, 'spiny', self.layer,
                            direction=self.direction)
-                self.groups()[0].add(spiny)
+                spiny.spawn = None
+                self.home_layer.section.npc_registry.spawn(spiny, self.home_layer)
         elif self.npc_type == 'boo':
             # Move away when player looks
             if player and player.direction * (player.rect.centerx - self.rect.centerx) > 0:
@@ -430,15 +981,9 @@ class NPC(GameObject):
                 self.velocity.x = self.direction * 2
 
     def _collide(self, tiles, axis):
-        for t in tiles:
+        for t in tiles.near(self.rect):
             if not self.rect.colliderect(t.rect):
                 continue
-            if t.tile_type == 'lava':
-                self.dead = True
-                self.death_timer = 10
-                return
-            if t.tile_type == 'water':
-                self.velocity.y *= 0.5
             if axis == 'x':
                 if self.velocity.x > 0:
                     self.rect.right = t.rect.left
@@ -501,7 +1046,7 @@ class Player(pygame.sprite.Sprite):
         self.can_shoot = True
         self.shoot_timer = 0
 
-    def update(self, solid_tiles, npc_group, events, section):
+    def update(self, solid_tiles, actors, events, section, inputs=None):
         if self.dead:
             self.death_timer -= 1
             if self.death_timer <= 0:
@@ -512,17 +1057,18 @@ class Player(pygame.sprite.Sprite):
                     return 'game_over'
             return 'alive'
 
-        keys = pygame.key.get_pressed()
+        if inputs is None:
+            inputs = InputState.from_keys(pygame.key.get_pressed())
         self.velocity.x = 0
-        if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+        if inputs.left:
             self.velocity.x = -MOVE_SPEED
             self.direction = -1
-        if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+        if inputs.right:
             self.velocity.x = MOVE_SPEED
             self.direction = 1
 
         # Jump
-        if keys[pygame.K_SPACE] or keys[pygame.K_UP] or keys[pygame.K_w]:
+        if inputs.jump:
             if self.on_ground and not self.jump_held:
                 self.velocity.y = JUMP_STRENGTH
                 self.on_ground = False
@@ -540,7 +1086,7 @@ class Player(pygame.sprite.Sprite):
         if self.powerup_state == 2:
             if self.shoot_timer > 0:
                 self.shoot_timer -= 1
-            if (keys[pygame.K_s] or keys[pygame.K_DOWN]) and self.shoot_timer == 0:
+            if inputs.fire and self.shoot_timer == 0:
                 fb = Fireball(self.rect.centerx, self.rect.top, self.direction, 0)
                 self.fireballs.append(fb)
                 self.shoot_timer = 20
@@ -558,8 +1104,11 @@ class Player(pygame.sprite.Sprite):
         self.on_ground = False
         self._collide(solid_tiles, 'y')
 
+        # Lava and water aren't solid; overlapping them is enough
+        self._touch(solid_tiles, 'hazard')
+
         # NPC collisions
-        for npc in npc_group:
+        for npc in actors.query(self.rect):
             if npc.dead:
                 continue
             if self.rect.colliderect(npc.rect):
@@ -570,7 +1119,8 @@ class Player(pygame.sprite.Sprite):
                     self.score += 100
                 # Power-up collection
                 elif npc.npc_type in ['mushroom', 'flower', 'star', '1up']:
-                    npc.kill()
+                    npc.dead = True  # death_timer 0: gone at NPCRegistry.flush()
+                    npc.death_timer = 0
                     if npc.npc_type == 'mushroom':
                         self.powerup_state = max(1, self.powerup_state)
                         self.score += 1000
@@ -595,26 +1145,14 @@ class Player(pygame.sprite.Sprite):
                     else:
                         self.die()
 
-        # Collect coins from tile map
-        for t in solid_tiles:
-            if t.tile_type == 'coin' and self.rect.colliderect(t.rect):
-                t.kill()
-                self.coins += 1
-                self.score += 200
-                play_sound('coin')
-                if self.coins >= 100:
-                    self.lives += 1
-                    self.coins -= 100
-
-        # Bump question blocks
-        for t in solid_tiles:
-            if t.tile_type in ['question', 'brick'] and self.rect.colliderect(t.rect):
-                if self.velocity.y < 0:  # hitting from below
-                    t.bump(self)
+        # Collect coins and bump blocks from the tile map
+        self._touch(solid_tiles, 'coin')
+        if self.velocity.y < 0:  # hitting from below
+            self._touch(solid_tiles, 'bumpable')
 
         # Update fireballs
         for fb in self.fireballs[:]:
-            fb.update(solid_tiles, npc_group, self)
+            fb.update(solid_tiles, actors, self)
             if not fb.alive():
                 self.fireballs.remove(fb)
 
@@ -641,30 +1179,57 @@ class Player(pygame.sprite.Sprite):
         self.powerup_state = 0
         self.invincible = 120
 
+    def _touch(self, tiles, kind):
+        # Hand each tile of one TILE_KINDS kind we overlap to its handler.
+        for t in tiles.near_kind(self.rect, kind):
+            if self.rect.colliderect(t.rect):
+                PLAYER_TILE_HANDLERS[t.store.types[t.row]](self, t)
+
+    def _hit_lava(self, t):
+        if not self.dead:
+            self.die()
+
+    def _in_water(self, t):
+        self.velocity.y *= 0.5
+
+    def _collect_coin(self, t):
+        t.kill()
+        self.coins += 1
+        self.score += 200
+        play_sound('coin')
+        if self.coins >= 100:
+            self.lives += 1
+            self.coins -= 100
+
+    def _bump(self, t):
+        t.bump(self)
+
+    def _press_pswitch(self, t):
+        section = t.home_layer.section
+        t.kill()
+        if section:
+            section.press_pswitch()
+
+    def _slope_left(self, t):
+        if self.rect.bottom > t.rect.top and self.velocity.y >= 0:
+            self.rect.bottom = t.rect.top + (self.rect.right - t.rect.left)
+            self.on_ground = True
+            self.velocity.y = 0
+
+    def _slope_right(self, t):
+        if self.rect.bottom > t.rect.top and self.velocity.y >= 0:
+            self.rect.bottom = t.rect.top + (t.rect.right - self.rect.left)
+            self.on_ground = True
+            self.velocity.y = 0
+
     def _collide(self, tiles, axis):
-        for t in tiles:
+        handlers = SOLID_TILE_HANDLERS
+        for t in tiles.near(self.rect):
             if not self.rect.colliderect(t.rect):
                 continue
-            if t.tile_type == 'lava':
-                self.die()
-                return
-            if t.tile_type == 'water':
-                self.velocity.y *= 0.5
-            if t.tile_type == 'pswitch':
-                t.kill()
-                # activate switch (not implemented)
-            if t.tile_type == 'slope_left':
-                offset = self.rect.bottom - t.rect.top
-                if offset > 0 and self.velocity.y >= 0:
-                    self.rect.bottom = t.rect.top + (self.rect.right - t.rect.left)
-                    self.on_ground = True
-                    self.velocity.y = 0
-            elif t.tile_type == 'slope_right':
-                offset = self.rect.bottom - t.rect.top
-                if offset > 0 and self.velocity.y >= 0:
-                    self.rect.bottom = t.rect.top + (t.rect.right - self.rect.left)
-                    self.on_ground = True
-                    self.velocity.y = 0
+            handler = handlers.get(t.store.types[t.row])
+            if handler is not None:
+                handler(self, t)
             if axis == 'x':
                 if self.velocity.x > 0:
                     self.rect.right = t.rect.left
@@ -679,6 +1244,19 @@ class Player(pygame.sprite.Sprite):
                     self.rect.top = t.rect.bottom
                 self.velocity.y = 0
 
+# Type id -> Player method for tiles that do more than block. _touch() looks
+# tiles up by kind and dispatches through the full table; _collide() only
+# checks the solid ones that act on contact during push-out.
+PLAYER_TILE_HANDLERS = {TILE_SMBX_IDS[name]: handler for name, handler in (
+    ('lava', Player._hit_lava), ('water', Player._in_water),
+    ('coin', Player._collect_coin),
+    ('question', Player._bump), ('brick', Player._bump),
+    ('pswitch', Player._press_pswitch),
+    ('slope_left', Player._slope_left), ('slope_right', Player._slope_right),
+)}
+SOLID_TILE_HANDLERS = {TILE_SMBX_IDS[name]: PLAYER_TILE_HANDLERS[TILE_SMBX_IDS[name]]
+                       for name in ('pswitch', 'slope_left', 'slope_right')}
+
 # ========================
 # WARP / EVENT CLASSES
 # ========================
@@ -697,57 +1275,1063 @@ class Event:
         self.trigger = trigger  # 'touch', 'kill', 'hit', etc.
         self.actions = actions  # list of (action_type, target, value)
 
+# ========================
+# SPATIAL INDEX
+# ========================
+def cell_key(x, y):
+    return (x // GRID_SIZE, y // GRID_SIZE)
+
+class StaticChunkCache:
+    # Pre-rendered BGOs and tiles of a section's visible layers, one surface per
+    # CHUNK_SIZE square. A chunk is baked the first time it is on screen and
+    # again only after a tile or BGO inside it changes.
+    def __init__(self, section):
+        self.section = section
+        self.chunks = OrderedDict()  # (kx, ky) -> Surface, or None if empty
+        self.generation = image_cache.generation
+        # World rects rebaked since take_damage(); None = all. Stays None
+        # until the first draw, so headless runs never collect any.
+        self.damage = None
+
+    def take_damage(self):
+        damage, self.damage = self.damage, []
+        return damage
+
+    def invalidate_rect(self, rect):
+        if self.damage is not None:
+            if len(self.damage) < MAX_DAMAGE_RECTS:
+                self.damage.append(rect)
+            else:
+                self.damage = None
+        for ky in range(rect.top // CHUNK_SIZE, (rect.bottom - 1) // CHUNK_SIZE + 1):
+            for kx in range(rect.left // CHUNK_SIZE, (rect.right - 1) // CHUNK_SIZE + 1):
+                self.chunks.pop((kx, ky), None)
+
+    def invalidate_all(self):
+        self.chunks.clear()
+        self.damage = None
+
+    def draw(self, surf, view, area=None):
+        # Blits the chunks under `area` (a world rect, default the whole view)
+        # at their place in the view.
+        if self.generation != image_cache.generation:
+            self.chunks.clear()  # shared images were repainted (theme change)
+            self.generation = image_cache.generation
+        chunks = self.chunks
+        area = area or view
+        for ky in range(area.top // CHUNK_SIZE, (area.bottom - 1) // CHUNK_SIZE + 1):
+            for kx in range(area.left // CHUNK_SIZE, (area.right - 1) // CHUNK_SIZE + 1):
+                key = (kx, ky)
+                if key in chunks:
+                    chunks.move_to_end(key)
+                    chunk = chunks[key]
+                else:
+                    chunk = chunks[key] = self._bake(kx, ky)
+                    if len(chunks) > MAX_CACHED_CHUNKS:
+                        chunks.popitem(last=False)
+                if chunk is not None:
+                    surf.blit(chunk, (kx * CHUNK_SIZE - view.x, ky * CHUNK_SIZE - view.y))
+
+    def _bake(self, kx, ky):
+        ox, oy = kx * CHUNK_SIZE, ky * CHUNK_SIZE
+        # Objects are found by their top-left corner, so start one cell early
+        # to catch those hanging into the chunk from the left/top.
+        cxs = range(ox // GRID_SIZE - 1, (ox + CHUNK_SIZE - 1) // GRID_SIZE + 1)
+        cys = range(oy // GRID_SIZE - 1, (oy + CHUNK_SIZE - 1) // GRID_SIZE + 1)
+        surf = None
+        layers = [layer for layer in self.section.layers if layer.visible]
+        for layer in layers:  # BGOs under tiles, as before
+            cells = layer.bgo_cells
+            if not cells:
+                continue
+            for cy in cys:
+                for cx in cxs:
+                    for obj in cells.get((cx, cy), ()):
+                        if surf is None:
+                            surf = pygame.Surface((CHUNK_SIZE, CHUNK_SIZE), pygame.SRCALPHA)
+                        surf.blit(obj.image, (obj.rect.x - ox, obj.rect.y - oy))
+        for layer in layers:
+            store = layer.tiles
+            if not store.live:
+                continue
+            xs, ys, types = store.xs, store.ys, store.types
+            for row in store.rows_near(cxs.start * GRID_SIZE, cys.start * GRID_SIZE,
+                                       ox + CHUNK_SIZE, oy + CHUNK_SIZE):
+                if surf is None:
+                    surf = pygame.Surface((CHUNK_SIZE, CHUNK_SIZE), pygame.SRCALPHA)
+                surf.blit(image_cache.get('tile', TILE_ID_TO_NAME[types[row]]),
+                          (xs[row] - ox, ys[row] - oy))
+        if surf is not None:
+            if pygame.display.get_surface() is not None:
+                surf = surf.convert_alpha()
+            # Chunks are mostly empty space; RLE makes blitting them cheap.
+            surf.set_alpha(255, pygame.RLEACCEL)
+        return surf
+
+NON_SOLID_TILES = frozenset(('coin', 'water', 'lava', 'vine'))
+INTERACTIVE_TILES = frozenset(('question', 'brick', 'pswitch', 'coin'))
+NON_SOLID_TILE_IDS = frozenset(TILE_SMBX_IDS[n] for n in NON_SOLID_TILES)
+INTERACTIVE_TILE_IDS = frozenset(TILE_SMBX_IDS[n] for n in INTERACTIVE_TILES)
+TILE_ALIVE = 1
+TILE_SOLID = 2
+# Tiles the player interacts with beyond plain collision, indexed by kind so
+# each interaction only looks at nearby tiles of its own kind. Solid tiles
+# that act during push-out (slopes, P-switches) are already in hand there
+# and go through SOLID_TILE_HANDLERS instead.
+TILE_KINDS = {
+    'coin': ('coin',),
+    'bumpable': ('question', 'brick'),
+    'hazard': ('lava', 'water'),
+}
+TILE_KIND_OF = {TILE_SMBX_IDS[name]: kind for kind, names in TILE_KINDS.items() for name in names}
+PSWITCH_TICKS = 10 * FPS
+TILE_BUCKET = 4 * GRID_SIZE  # pixel size of a TileStore spatial bucket
+BUCKET_STRIDE = 1 << 24
+MAX_TRANSIENT_HANDLES = 4096
+MAX_NEAR_WINDOWS = 1 << 15  # memoised TileIndex.near() results
+
+class TileStore:
+    # Struct-of-arrays storage for one layer's tiles: x, y, SMBX type id,
+    # flags, event id and a state byte (TILE_ALIVE | TILE_SOLID) per row. Rows
+    # are bucketed by TILE_BUCKET squares in small int arrays, which keeps a
+    # static tile at a few dozen bytes. Removed rows are tombstoned, never
+    # reused, so a row number stays a stable id for its tile until compact(),
+    # which only the section streamer runs.
+    def __init__(self, layer=None):
+        self.layer = layer
+        self.xs = array('q')  # LVL coordinates are u32
+        self.ys = array('q')
+        self.types = array('H')
+        self.flags = array('I')
+        self.events = array('q')
+        self.state = array('B')
+        self.buckets = {}   # bucket key -> array of rows anchored in it
+        self.kinds = {}     # TILE_KINDS kind -> bucket key -> {row: None}
+        self.handles = {}   # row -> Tile, interactive tiles only
+        self._recent = {}   # row -> Tile, recently used handles of static tiles
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def __iter__(self):
+        state = self.state
+        for row in range(len(state)):
+            if state[row] & TILE_ALIVE:
+                yield self.handle(row, cache=False)
+
+    def _bucket_add(self, row, x, y):
+        key = x // TILE_BUCKET + (y // TILE_BUCKET) * BUCKET_STRIDE
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = array('i', (row,))
+        else:
+            bucket.append(row)
+
+    def _kind_add(self, kind, row, x, y):
+        key = x // TILE_BUCKET + (y // TILE_BUCKET) * BUCKET_STRIDE
+        self.kinds.setdefault(kind, {}).setdefault(key, {})[row] = None
+
+    def _kind_remove(self, kind, row, x, y):
+        key = x // TILE_BUCKET + (y // TILE_BUCKET) * BUCKET_STRIDE
+        buckets = self.kinds[kind]
+        bucket = buckets[key]
+        del bucket[row]
+        if not bucket:
+            del buckets[key]
+            if not buckets:
+                del self.kinds[kind]
+
+    def _index_kinds(self):
+        # Full pass for columns loaded wholesale.
+        self.kinds = {}
+        kind_of = TILE_KIND_OF
+        if kind_of.keys().isdisjoint(self.types):
+            return
+        xs, ys, state = self.xs, self.ys, self.state
+        for row, type_id in enumerate(self.types):
+            kind = kind_of.get(type_id)
+            if kind is not None and state[row] & TILE_ALIVE:
+                self._kind_add(kind, row, xs[row], ys[row])
+
+    def append(self, x, y, type_id, event_id=-1, flags=0):
+        # Raw insert used by loaders; add() is the version that notifies.
+        row = len(self.xs)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.types.append(type_id)
+        self.flags.append(flags)
+        self.events.append(event_id)
+        self.state.append(TILE_ALIVE if type_id in NON_SOLID_TILE_IDS else TILE_ALIVE | TILE_SOLID)
+        self._bucket_add(row, x, y)
+        kind = TILE_KIND_OF.get(type_id)
+        if kind is not None:
+            self._kind_add(kind, row, x, y)
+        self.live += 1
+        return row
+
+    def extend(self, records):
+        # Bulk raw insert of (x, y, type_id, event_id, flags) records.
+        if not records:
+            return
+        start = len(self.xs)
+        xs, ys, types, events, flags = zip(*records)
+        self.xs.extend(xs)
+        self.ys.extend(ys)
+        self.types.extend(types)
+        self.events.extend(events)
+        self.flags.extend(flags)
+        non_solid = NON_SOLID_TILE_IDS
+        self.state.extend(array('B', [TILE_ALIVE if t in non_solid else TILE_ALIVE | TILE_SOLID
+                                      for t in types]))
+        kind_of = TILE_KIND_OF
+        for row, x, y, type_id in zip(range(start, start + len(xs)), xs, ys, types):
+            self._bucket_add(row, x, y)
+            kind = kind_of.get(type_id)
+            if kind is not None:
+                self._kind_add(kind, row, x, y)
+        self.live += len(xs)
+
+    def load_columns(self, columns, buckets):
+        # Adopts prebuilt (xs, ys, types, events, flags, state) columns and
+        # their bucket table wholesale; used on an empty store by the level
+        # cache loader.
+        self.xs, self.ys, self.types, self.events, self.flags, self.state = columns
+        self.buckets = buckets
+        self.live = len(self.xs)
+        self._index_kinds()
+
+    def add(self, *tiles):
+        for tile in tiles:
+            if tile.store is self:
+                continue
+            src, r = tile.store, tile.row
+            row = self.append(src.xs[r], src.ys[r], src.types[r], src.events[r], src.flags[r])
+            if src.layer is not None:
+                src.remove_row(r)
+            tile._bind(self, row)
+            if self.types[row] in INTERACTIVE_TILE_IDS:
+                self.handles[row] = tile
+            if self.layer:
+                self.layer._tiles_changed(tile.rect)
+
+    def remove(self, *tiles):
+        for tile in tiles:
+            if tile.store is self:
+                self.remove_row(tile.row)
+
+    def remove_row(self, row, notify=True):
+        if not self.state[row] & TILE_ALIVE:
+            return
+        self.state[row] = 0
+        x, y = self.xs[row], self.ys[row]
+        key = x // TILE_BUCKET + (y // TILE_BUCKET) * BUCKET_STRIDE
+        bucket = self.buckets[key]
+        bucket.remove(row)
+        if not bucket:
+            del self.buckets[key]
+        kind = TILE_KIND_OF.get(self.types[row])
+        if kind is not None:
+            self._kind_remove(kind, row, x, y)
+        self.handles.pop(row, None)
+        self._recent.pop(row, None)
+        self.live -= 1
+        if self.layer and notify:
+            self.layer._tiles_changed(pygame.Rect(x, y, GRID_SIZE, GRID_SIZE))
+
+    def compact(self):
+        # Drops tombstoned rows and renumbers the rest. Returns old row -> new
+        # row (-1 if dropped); interactive handles are rebound to their new
+        # rows, transient ones are forgotten.
+        state = self.state
+        remap = array('i', [-1]) * len(state)
+        keep = []
+        for row in range(len(state)):
+            if state[row] & TILE_ALIVE:
+                remap[row] = len(keep)
+                keep.append(row)
+        for name in ('xs', 'ys', 'types', 'events', 'flags', 'state'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, [column[row] for row in keep]))
+        self.buckets = {}
+        for row, (x, y) in enumerate(zip(self.xs, self.ys)):
+            self._bucket_add(row, x, y)
+        self._index_kinds()
+        handles = {}
+        for old, tile in self.handles.items():
+            tile.row = remap[old]
+            handles[tile.row] = tile
+        self.handles = handles
+        self._recent.clear()
+        return remap
+
+    def set_type(self, row, type_id):
+        if self.types[row] == type_id:
+            return
+        old, new = TILE_KIND_OF.get(self.types[row]), TILE_KIND_OF.get(type_id)
+        if old != new and self.state[row] & TILE_ALIVE:
+            x, y = self.xs[row], self.ys[row]
+            if old is not None:
+                self._kind_remove(old, row, x, y)
+            if new is not None:
+                self._kind_add(new, row, x, y)
+        self.types[row] = type_id
+        solid = 0 if type_id in NON_SOLID_TILE_IDS else TILE_SOLID
+        if self.state[row] & TILE_SOLID != solid:
+            self.state[row] = (self.state[row] & ~TILE_SOLID) | solid
+        if self.layer:  # new image in the baked chunk even if still solid
+            self.layer._tiles_changed(pygame.Rect(self.xs[row], self.ys[row], GRID_SIZE, GRID_SIZE))
+
+    def handle(self, row, cache=True):
+        tile = self.handles.get(row)
+        if tile is None:
+            tile = self._recent.get(row)
+            if tile is None:
+                tile = Tile.for_row(self, row)
+                if self.types[row] in INTERACTIVE_TILE_IDS:
+                    self.handles[row] = tile
+                elif cache:
+                    if len(self._recent) >= MAX_TRANSIENT_HANDLES:
+                        self._recent.clear()
+                    self._recent[row] = tile
+        return tile
+
+    def rows_near(self, left, top, right, bottom, kind=None):
+        # Live rows whose top-left corner lies in [left, right) x [top, bottom),
+        # of one TILE_KINDS kind if given.
+        buckets = self.buckets if kind is None else self.kinds.get(kind, {})
+        xs, ys = self.xs, self.ys
+        for by in range(top // TILE_BUCKET, (bottom - 1) // TILE_BUCKET + 1):
+            for bx in range(left // TILE_BUCKET, (right - 1) // TILE_BUCKET + 1):
+                bucket = buckets.get(bx + by * BUCKET_STRIDE)
+                if bucket:
+                    for row in bucket:
+                        if left <= xs[row] < right and top <= ys[row] < bottom:
+                            yield row
+
+class TileMapView(Mapping):
+    # (x, y) -> Tile lookups over a TileStore, standing in for the old dict.
+    def __init__(self, store):
+        self.store = store
+
+    def _row(self, pos):
+        x, y = pos
+        for row in self.store.rows_near(x, y, x + 1, y + 1):
+            return row
+        return None
+
+    def __getitem__(self, pos):
+        row = self._row(pos)
+        if row is None:
+            raise KeyError(pos)
+        return self.store.handle(row)
+
+    def __contains__(self, pos):
+        return self._row(pos) is not None
+
+    def __iter__(self):
+        store = self.store
+        for row, st in enumerate(store.state):
+            if st & TILE_ALIVE:
+                yield (store.xs[row], store.ys[row])
+
+    def __len__(self):
+        return len(self.store)
+
+class SpatialHash:
+    # Objects bucketed by every cell their rect touches. Buckets are dicts
+    # used as ordered sets, so queries come back in a repeatable order.
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.keys = {}  # obj -> cells it is filed under
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, obj):
+        return obj in self.keys
+
+    def _cells(self, rect):
+        cs = self.cell_size
+        return [(cx, cy)
+                for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1)
+                for cx in range(rect.left // cs, (rect.right - 1) // cs + 1)]
+
+    def insert(self, obj, rect):
+        if obj in self.keys:
+            self.remove(obj)
+        keys = self._cells(rect)
+        self.keys[obj] = keys
+        cells = self.cells
+        for key in keys:
+            bucket = cells.get(key)
+            if bucket is None:
+                cells[key] = {obj: None}
+            else:
+                bucket[obj] = None
+
+    def remove(self, obj):
+        keys = self.keys.pop(obj, None)
+        if keys is None:
+            return False
+        for key in keys:
+            bucket = self.cells[key]
+            del bucket[obj]
+            if not bucket:
+                del self.cells[key]
+        return True
+
+    def query(self, rect):
+        found = {}
+        cells = self.cells
+        for key in self._cells(rect):
+            bucket = cells.get(key)
+            if bucket:
+                found.update(bucket)
+        return list(found)
+
+class BroadPhase:
+    # Broad phase for the awake NPCs. Hashing them into cells every tick cost
+    # more in Python than the loops it saved, since they all move, so it keeps
+    # a list of their live Rect objects instead - rebuilt only when the awake
+    # list itself is replaced - and lets pygame's C collidelistall() find the
+    # overlaps. Candidates come back in awake-list order, so the narrow phase
+    # handles them in the same order a plain loop over the list would.
+    def __init__(self):
+        self.npcs = []
+        self.rects = []
+
+    def update(self, npcs):
+        if npcs is not self.npcs:
+            self.npcs = npcs
+            self.rects = [npc.rect for npc in npcs]
+
+    def query(self, rect):
+        # NPCs whose rect overlaps rect.
+        npcs = self.npcs
+        return [npcs[i] for i in rect.collidelistall(self.rects)]
+
+    def pairs(self, movers):
+        # (mover, npc) candidate pairs for NPC-vs-NPC checks.
+        for mover in movers:
+            for npc in self.query(mover.rect):
+                if npc is not mover:
+                    yield mover, npc
+
+class NPCRegistry:
+    # Section-wide NPC bookkeeping. Every NPC on the section's layers sits in
+    # one dense list (swap-remove through npc.slot) under an id that stays
+    # the same for as long as it exists. During a tick, spawns are only
+    # queued and NPCs that die stay where they are; flush() at the end of
+    # the tick moves the newly dead off the active list into `dying`, counts
+    # down their death_timer and lands the queued spawns, so lists handed
+    # out for the tick never change under whoever is iterating them.
+    def __init__(self, section):
+        self.section = section
+        self.npcs = []
+        self.by_id = {}
+        self.next_id = 1
+        self.dying = {}    # npc -> None, in order of death
+        self.spawns = []   # (npc, layer)
+
+    def __len__(self):
+        return len(self.npcs)
+
+    def get(self, npc_id):
+        return self.by_id.get(npc_id)
+
+    def insert(self, npc):
+        if npc.npc_id is None:
+            npc.npc_id = self.next_id
+            self.next_id += 1
+        npc.slot = len(self.npcs)
+        self.npcs.append(npc)
+        self.by_id[npc.npc_id] = npc
+
+    def discard(self, npc):
+        slot = npc.slot
+        if slot is None:
+            return
+        last = self.npcs.pop()
+        if last is not npc:
+            self.npcs[slot] = last
+            last.slot = slot
+        npc.slot = None
+        del self.by_id[npc.npc_id]
+        self.dying.pop(npc, None)
+
+    def spawn(self, npc, layer):
+        self.spawns.append((npc, layer))
+
+    def flush(self):
+        activation = self.section.activation
+        for npc in activation.active_list():
+            if npc.dead:
+                activation.discard(npc)
+                self.dying[npc] = None
+        expired = []
+        for npc in self.dying:
+            npc.death_timer -= 1
+            if npc.death_timer <= 0:
+                expired.append(npc)
+        for npc in expired:
+            npc.kill()  # discard() runs from the layer's remove hook
+        spawns, self.spawns = self.spawns, []
+        for npc, layer in spawns:
+            layer.npcs.add(npc)
+
+def _wake_order(npc):
+    return npc.rect.x, npc.rect.y, npc.npc_type, npc.spawn or ()
+
+class NPCActivation:
+    # SMBX-style activation for a section's NPCs. Everything starts dormant in
+    # a SpatialHash and costs nothing per tick; NPCs wake when they come
+    # within `margin` of the camera view. After `timeout` ticks out of range a
+    # placed NPC is reset to its spawn point and sleeps again (not while that
+    # spawn point is itself in range), and one spawned during play despawns.
+    # With reset=False they just fall asleep where they are.
+    def __init__(self, section, margin=ACTIVATION_MARGIN, timeout=DORMANT_TIMEOUT,
+                 reset=True):
+        self.section = section
+        self.margin = margin
+        self.timeout = timeout
+        self.reset = reset
+        self.dormant = SpatialHash(8 * GRID_SIZE)
+        self.active = {}   # npc -> ticks spent out of range, in wake-up order
+        self._list = None
+        self._stale = True
+
+    def invalidate(self):
+        # Layer visibility changed; sort NPCs out again on the next update.
+        self._stale = True
+        self._list = None
+
+    def add(self, npc):
+        if not self._stale:
+            self.dormant.insert(npc, npc.rect)
+
+    def discard(self, npc):
+        if self.active.pop(npc, None) is not None:
+            self._list = None
+        self.dormant.remove(npc)
+
+    def active_list(self):
+        # Replaced, never mutated, like Section.get_all_npcs().
+        if self._stale:
+            self._rebuild()
+        if self._list is None:
+            self._list = list(self.active)
+        return self._list
+
+    def _rebuild(self):
+        visible = {}
+        for layer in self.section.layers:
+            if layer.visible:
+                for npc in layer.npcs:
+                    if not npc.dead:
+                        visible[npc] = None
+        self.active = {npc: away for npc, away in self.active.items() if npc in visible}
+        self.dormant = SpatialHash(self.dormant.cell_size)
+        for npc in visible:
+            if npc not in self.active:
+                self.dormant.insert(npc, npc.rect)
+        self._list = None
+        self._stale = False
+
+    def update(self, view):
+        if self._stale:
+            self._rebuild()
+        zone = view.inflate(2 * self.margin, 2 * self.margin)
+        active = self.active
+        # Wake in position order, not bucket order: bucket order depends on
+        # insertion history, which differs between whole and streamed loads.
+        woken = [npc for npc in self.dormant.query(zone) if zone.colliderect(npc.rect)]
+        if woken:
+            woken.sort(key=_wake_order)
+            for npc in woken:
+                self.dormant.remove(npc)
+                active[npc] = 0
+            self._list = None
+        expired = []
+        for npc, away in active.items():
+            if zone.colliderect(npc.rect):
+                if away:
+                    active[npc] = 0
+            elif away + 1 < self.timeout:
+                active[npc] = away + 1
+            else:
+                expired.append(npc)
+        for npc in expired:
+            self._sleep(npc, zone)
+
+    def _sleep(self, npc, zone):
+        if npc.spawn is None:
+            npc.kill()  # discard() runs from the layer's remove hook
+            return
+        if self.reset:
+            x, y, _ = npc.spawn
+            if zone.colliderect((x, y, npc.rect.width, npc.rect.height)):
+                return  # never pop back in where the player can see it
+            npc.respawn()
+        del self.active[npc]
+        self._list = None
+        self.dormant.insert(npc, npc.rect)
+
+class LayerGroup(pygame.sprite.Group):
+    # Reports every membership change to the owning layer, including removals
+    # that happen through Sprite.kill(), so indexes and cached views built on
+    # top of the layer never have to rescan it.
+    def __init__(self, owner, kind):
+        super().__init__()
+        self.owner = owner
+        self.kind = kind
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.owner._on_add(self.kind, sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.owner._on_remove(self.kind, sprite)
+
+class TileIndex:
+    # Persistent view of a section's solid tiles. Tiles are found by the cell
+    # of their top-left corner, so a tile can reach at most one cell to the
+    # right/below its anchor; lookups widen the range by one cell to match.
+    # Results are memoised per cell window until the section's tiles change:
+    # walkers sharing a stretch of floor all get the same list back.
+    def __init__(self, section):
+        self.section = section
+        self._memo = {}
+        self._memo_version = -1
+
+    def near(self, rect):
+        x0 = rect.left // GRID_SIZE - 1
+        x1 = (rect.right - 1) // GRID_SIZE
+        y0 = rect.top // GRID_SIZE - 1
+        y1 = (rect.bottom - 1) // GRID_SIZE
+        if self._memo_version != self.section.tiles_version:
+            self._memo.clear()
+            self._memo_version = self.section.tiles_version
+        key = (x0, y0, x1, y1)
+        found = self._memo.get(key)
+        if found is None:
+            found = self._scan(x0 * GRID_SIZE, y0 * GRID_SIZE,
+                               (x1 + 1) * GRID_SIZE, (y1 + 1) * GRID_SIZE)
+            if len(self._memo) >= MAX_NEAR_WINDOWS:
+                self._memo.clear()
+            self._memo[key] = found
+        return found
+
+    def _scan(self, left, top, right, bottom):
+        found = []
+        bxs = range(left // TILE_BUCKET, (right - 1) // TILE_BUCKET + 1)
+        bys = range(top // TILE_BUCKET, (bottom - 1) // TILE_BUCKET + 1)
+        for layer in self.section.layers:
+            store = layer.tiles
+            if not store.live or not layer.visible:
+                continue
+            state, xs, ys, buckets = store.state, store.xs, store.ys, store.buckets
+            hits = []
+            for by in bys:
+                for bx in bxs:
+                    bucket = buckets.get(bx + by * BUCKET_STRIDE)
+                    if bucket:
+                        for row in bucket:
+                            x, y = xs[row], ys[row]
+                            if (left <= x < right and top <= y < bottom
+                                    and state[row] & TILE_SOLID):
+                                hits.append((y // GRID_SIZE, x // GRID_SIZE, row))
+            # Resolve collisions row by row, left to right, like the old
+            # per-cell index did; the order decides who gets pushed where.
+            hits.sort()
+            for _, _, row in hits:
+                found.append(store.handle(row))
+        return found
+
+    def near_kind(self, rect, kind):
+        # Live tiles of one TILE_KINDS kind (solid or not) on visible layers,
+        # over the same window and in the same order as near(). The per-kind
+        # buckets are sparse, so this is not memoised.
+        left = (rect.left // GRID_SIZE - 1) * GRID_SIZE
+        top = (rect.top // GRID_SIZE - 1) * GRID_SIZE
+        right = ((rect.right - 1) // GRID_SIZE + 1) * GRID_SIZE
+        bottom = ((rect.bottom - 1) // GRID_SIZE + 1) * GRID_SIZE
+        found = []
+        for layer in self.section.layers:
+            store = layer.tiles
+            if kind not in store.kinds or not layer.visible:
+                continue
+            xs, ys = store.xs, store.ys
+            hits = sorted((ys[row] // GRID_SIZE, xs[row] // GRID_SIZE, row)
+                          for row in store.rows_near(left, top, right, bottom, kind))
+            for _, _, row in hits:
+                found.append(store.handle(row))
+        return found
+
+# ========================
+# WALKER BATCH
+# ========================
+# Goombas, koopas, buzzies and spinies share the same walk/fall/turn-at-wall
+# physics, so with numpy available they are stepped together on a grid of
+# solid cells instead of one NPC.update() at a time. NPC.update() stays the
+# reference: any walker the grid can't resolve exactly (off-grid tiles, more
+# than one push-out per axis) is simply handed to it for that tick.
+WALKER_TYPES = frozenset(('goomba', 'koopa_green', 'koopa_red', 'buzzy', 'spiny'))
+KOOPA_WALKERS = frozenset(('koopa_green', 'koopa_red'))  # turn around at random
+WALKER_SIZE = (GRID_SIZE, GRID_SIZE)
+WALKER_BATCH_MIN = 64  # below this numpy's per-call overhead isn't worth it
+CELL_EMPTY, CELL_SOLID, CELL_COMPLEX = 0, 1, 2
+
+class SolidGrid:
+    # Solid tiles of a section's visible layers rasterised to cells. A cell is
+    # CELL_SOLID when exactly one grid-aligned tile sits in it and nothing else
+    # reaches into it; anything messier is CELL_COMPLEX.
+    def __init__(self, section):
+        G = GRID_SIZE
+        xs, ys = [], []
+        for layer in section.layers:
+            store = layer.tiles
+            if layer.visible and store.live:
+                solid = (np.frombuffer(store.state, dtype=np.uint8) & TILE_SOLID) != 0
+                xs.append(np.frombuffer(store.xs, dtype=np.int64)[solid])
+                ys.append(np.frombuffer(store.ys, dtype=np.int64)[solid])
+        xs = np.concatenate(xs) if xs else np.zeros(0, np.int64)
+        ys = np.concatenate(ys) if ys else np.zeros(0, np.int64)
+        # Stray tiles far past the section's right or bottom edge would make
+        # the grid arbitrarily large. They are left off it, and every cell
+        # from that edge on is CELL_COMPLEX instead (clamping included).
+        far_x = (section.width // G + 4) * G
+        far_y = (section.height // G + 4) * G
+        stray_x = bool((xs >= far_x).any())
+        stray_y = bool((ys >= far_y).any())
+        if stray_x or stray_y:
+            keep = (xs < far_x) & (ys < far_y)
+            xs, ys = xs[keep], ys[keep]
+        if not len(xs):
+            self.ox = self.oy = 0
+            self.cells = np.full((1, 1), CELL_COMPLEX if stray_x or stray_y else CELL_EMPTY, np.int8)
+            return
+        self.ox = int(xs.min()) // G - 1
+        self.oy = int(ys.min()) // G - 1
+        w = int(xs.max()) // G + 3 - self.ox
+        h = int(ys.max()) // G + 3 - self.oy
+        if stray_x:
+            w = max(w, far_x // G + 1 - self.ox)
+        if stray_y:
+            h = max(h, far_y // G + 1 - self.oy)
+        counts = np.zeros((h, w), np.int32)
+        aligned = (xs % G == 0) & (ys % G == 0)
+        np.add.at(counts, (ys[aligned] // G - self.oy, xs[aligned] // G - self.ox), 1)
+        # An off-grid tile overlaps up to four cells; poison all of them.
+        xo, yo = xs[~aligned], ys[~aligned]
+        for cx in (xo // G, (xo + G - 1) // G):
+            for cy in (yo // G, (yo + G - 1) // G):
+                np.add.at(counts, (cy - self.oy, cx - self.ox), CELL_COMPLEX)
+        if stray_x:
+            counts[:, far_x // G - self.ox:] = CELL_COMPLEX
+        if stray_y:
+            counts[far_y // G - self.oy:, :] = CELL_COMPLEX
+        self.cells = np.minimum(counts, CELL_COMPLEX).astype(np.int8)
+
+    def touching(self, x, y):
+        # Cell values under GRID_SIZE squares at (x, y), in the order
+        # TileIndex.near() hands tiles to NPC._collide(). The grid has an
+        # empty border, so clamping puts everything outside it on empty cells.
+        G = GRID_SIZE
+        h, w = self.cells.shape
+        flat = self.cells.ravel()
+        cx0, cx1 = x // G, (x + G - 1) // G
+        cy0, cy1 = y // G, (y + G - 1) // G
+        ix0 = np.minimum(np.maximum(cx0 - self.ox, 0), w - 1)
+        ix1 = np.minimum(np.maximum(cx1 - self.ox, 0), w - 1)
+        iy0 = np.minimum(np.maximum(cy0 - self.oy, 0), h - 1) * w
+        iy1 = np.minimum(np.maximum(cy1 - self.oy, 0), h - 1) * w
+        return ((cx0, cy0, flat[iy0 + ix0]), (cx1, cy0, flat[iy0 + ix1]),
+                (cx0, cy1, flat[iy1 + ix0]), (cx1, cy1, flat[iy1 + ix1]))
+
+def _first_hit(cells):
+    # Column/row of the first solid cell in collision order, plus whether
+    # there was one and whether any cell needs the per-object path.
+    hit = np.zeros(len(cells[0][2]), bool)
+    complex_ = np.zeros_like(hit)
+    hx = np.zeros(len(hit), np.int64)
+    hy = np.zeros(len(hit), np.int64)
+    for cx, cy, value in cells:
+        new = (value == CELL_SOLID) & ~hit
+        hx = np.where(new, cx, hx)
+        hy = np.where(new, cy, hy)
+        hit |= new
+        complex_ |= value == CELL_COMPLEX
+    return hit, hx, hy, complex_
+
+def _overlaps_solid(grid, x, y):
+    blocked = np.zeros(len(x), bool)
+    for _, _, value in grid.touching(x, y):
+        blocked |= value != CELL_EMPTY
+    return blocked
+
+def _rect_round(v):
+    # pygame.Rect rounds float coordinates half away from zero.
+    return np.trunc(v + np.copysign(0.5, v)).astype(np.int64)
+
+class WalkerBatch:
+    def __init__(self):
+        self._grid = None
+        self._grid_section = None
+        self._grid_version = -1
+
+    def grid(self, section):
+        if self._grid_section is not section or self._grid_version != section.tiles_version:
+            self._grid = SolidGrid(section)
+            self._grid_section = section
+            self._grid_version = section.tiles_version
+        return self._grid
+
+    def update(self, npcs, section, player):
+        solid_tiles = section.tile_index
+        fireballs, events = player.fireballs, section.events
+        walkers = [npc for npc in npcs
+                   if npc.npc_type in WALKER_TYPES and not npc.dead and npc.state == 'normal'
+                   and npc.rect.size == WALKER_SIZE]
+        if len(walkers) < WALKER_BATCH_MIN:
+            for npc in npcs:
+                npc.update(solid_tiles, player, fireballs, events)
+            return
+        results = self._step(walkers, self.grid(section))
+        # Write back in list order; everything else (and any walker the batch
+        # gave up on) runs the per-object path in between, exactly as before.
+        xs, ys, vxs, vys, dirs, grounded, fallback = results
+        walkers.append(None)  # sentinel, never matches
+        i = 0
+        nxt = walkers[0]
+        for npc in npcs:
+            if npc is not nxt:
+                npc.update(solid_tiles, player, fireballs, events)
+                continue
+            if fallback[i]:
+                npc.update(solid_tiles, player, fireballs, events)
+            else:
+                npc.rect.topleft = (xs[i], ys[i])
+                npc.velocity.update(vxs[i], vys[i])
+                npc.direction = dirs[i]
+                if grounded[i]:
+                    npc.on_ground = True
+                    if npc.npc_type in KOOPA_WALKERS and rng.random() < 0.01:
+                        npc.velocity.x *= -1
+                        npc.direction *= -1
+            i += 1
+            nxt = walkers[i]
+
+    def _step(self, walkers, grid):
+        G = GRID_SIZE
+        x = np.array([npc.rect.x for npc in walkers], np.int64)
+        y = np.array([npc.rect.y for npc in walkers], np.int64)
+        vx = np.array([npc.velocity.x for npc in walkers])
+        vy = np.array([npc.velocity.y for npc in walkers])
+        direction = np.array([npc.direction for npc in walkers])
+        grounded = np.array([npc.on_ground for npc in walkers], bool)
+
+        vy = np.minimum(vy + GRAVITY, TERMINAL_VELOCITY)
+        fallback = vy <= 0  # only falling walkers land the simple way
+
+        # Horizontal: move, then push out of the first wall hit and turn.
+        x = _rect_round(x + vx)
+        hit, hx, _, complex_ = _first_hit(grid.touching(x, y))
+        fallback |= complex_
+        x = np.where(hit, np.where(vx > 0, hx * G - G, hx * G + G), x)
+        vx = np.where(hit, -vx, vx)
+        direction = np.where(hit, -direction, direction)
+        fallback |= hit & _overlaps_solid(grid, x, y)
+
+        # Vertical: fall, then land on the first floor tile hit.
+        y = _rect_round(y + vy)
+        hit, _, hy, complex_ = _first_hit(grid.touching(x, y))
+        fallback |= complex_
+        y = np.where(hit, hy * G - G, y)
+        vy = np.where(hit, 0.0, vy)
+        grounded |= hit
+        fallback |= hit & _overlaps_solid(grid, x, y)
+
+        return (x.tolist(), y.tolist(), vx.tolist(), vy.tolist(), direction.tolist(),
+                grounded.tolist(), fallback.tolist())
+
 # ========================
 # LAYER / SECTION / LEVEL
 # ========================
 class Layer:
     def __init__(self, name="Layer 1", visible=True, locked=False):
         self.name = name
-        self.visible = visible
+        self.section = None  # set by Section.add_layer
+        self.index = 0
+        self._visible = visible
         self.locked = locked
-        self.tiles = pygame.sprite.Group()
-        self.bgos = pygame.sprite.Group()
-        self.npcs = pygame.sprite.Group()
-        self.tile_map = {}
+        self.tiles = TileStore(self)
+        self.bgos = LayerGroup(self, 'bgos')
+        self.npcs = LayerGroup(self, 'npcs')
+        self.tile_map = TileMapView(self.tiles)
+        self.bgo_cells = {}
+
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, value):
+        if value != self._visible:
+            self._visible = value
+            if self.section:
+                self.section.changed('layers')
 
     def add_tile(self, tile):
         self.tiles.add(tile)
-        self.tile_map[(tile.rect.x, tile.rect.y)] = tile
 
     def remove_tile(self, tile):
         self.tiles.remove(tile)
-        self.tile_map.pop((tile.rect.x, tile.rect.y), None)
+
+    def _tiles_changed(self, rect):
+        if self.section:
+            self.section.changed('tiles', rect)
+
+    def _on_add(self, kind, sprite):
+        sprite.home_layer = self
+        if kind == 'bgos':
+            self._index(self.bgo_cells, sprite)
+        if self.section:
+            if kind == 'npcs':
+                self.section.npc_registry.insert(sprite)
+                if self._visible:
+                    self.section.activation.add(sprite)
+            self.section.changed(kind, sprite.rect)
+
+    def _on_remove(self, kind, sprite):
+        if kind == 'bgos':
+            self._unindex(self.bgo_cells, sprite)
+        if self.section:
+            if kind == 'npcs':
+                self.section.npc_registry.discard(sprite)
+                self.section.activation.discard(sprite)
+            self.section.changed(kind, sprite.rect)
+
+    def _index(self, cells, obj):
+        cells.setdefault(cell_key(obj.rect.x, obj.rect.y), []).append(obj)
+
+    def _unindex(self, cells, obj):
+        key = cell_key(obj.rect.x, obj.rect.y)
+        bucket = cells.get(key)
+        if bucket and obj in bucket:
+            bucket.remove(obj)
+            if not bucket:
+                del cells[key]
 
 class Section:
     def __init__(self, width=100, height=30):
         self.width = width * GRID_SIZE
         self.height = height * GRID_SIZE
-        self.layers = [Layer("Layer 1")]
+        self.layers = []
         self.current_layer_idx = 0
         self.bg_color = (92,148,252)
         self.music = 1
         self.events = []
         self.warps = []
         self.background_image = None
+        self.tile_index = TileIndex(self)
+        self.chunks = StaticChunkCache(self)
+        self.npc_registry = NPCRegistry(self)
+        self.activation = NPCActivation(self)
+        # Bumped on every tile/NPC membership or layer visibility change; the
+        # lists handed out below are rebuilt only when their version is stale
+        # and are replaced, never mutated, so callers may iterate them while
+        # sprites are killed or spawned.
+        self.tiles_version = 0
+        self.npcs_version = 0
+        self._solid_tiles = ([], -1)
+        self._npcs = ([], -1)
+        self.pswitch_timer = 0
+        self.stream = None  # SectionStream when the section is streamed from its file
+        self.add_layer(Layer("Layer 1"))
 
     def current_layer(self):
         return self.layers[self.current_layer_idx]
 
-    def get_solid_tiles(self):
-        tiles = []
+    def add_layer(self, layer):
+        layer.section = self
+        layer.index = len(self.layers)
+        self.layers.append(layer)
+        for npc in layer.npcs:
+            self.npc_registry.insert(npc)
+        self.changed('layers')
+        return layer
+
+    def layer_at(self, idx):
+        while len(self.layers) <= idx:
+            self.add_layer(Layer(f"Layer {len(self.layers)+1}"))
+        return self.layers[idx]
+
+    def changed(self, kind, rect=None):
+        if kind == 'tiles':
+            self.tiles_version += 1
+            self.chunks.invalidate_rect(rect)
+        elif kind == 'bgos':
+            self.chunks.invalidate_rect(rect)
+        elif kind == 'npcs':
+            self.npcs_version += 1
+        elif kind == 'rows':
+            self.tiles_version += 1  # renumbered by compact(), nothing moved
+        elif kind == 'layers':
+            self.tiles_version += 1
+            self.npcs_version += 1
+            self.chunks.invalidate_all()
+            self.activation.invalidate()
+
+    def press_pswitch(self):
+        # Every coin in the section turns into a brick and every brick into a
+        # coin until the timer runs out; pressing again only restarts it.
+        if not self.pswitch_timer:
+            self._swap_coins_and_bricks()
+        self.pswitch_timer = PSWITCH_TICKS
+
+    def tick_pswitch(self):
+        if self.pswitch_timer:
+            self.pswitch_timer -= 1
+            if not self.pswitch_timer:
+                self._swap_coins_and_bricks()
+
+    def _swap_coins_and_bricks(self):
+        coin, brick = TILE_SMBX_IDS['coin'], TILE_SMBX_IDS['brick']
         for layer in self.layers:
-            if layer.visible:
-                for t in layer.tiles:
-                    if t.is_solid:
-                        tiles.append(t)
+            store = layer.tiles
+            kinds = store.kinds
+            coins = [row for bucket in kinds.get('coin', {}).values() for row in bucket]
+            bricks = [row for bucket in kinds.get('bumpable', {}).values() for row in bucket
+                      if store.types[row] == brick]
+            for row in coins:
+                store.set_type(row, brick)
+            for row in bricks:
+                store.set_type(row, coin)
+
+    def get_solid_tiles(self):
+        tiles, version = self._solid_tiles
+        if version != self.tiles_version:
+            tiles = []
+            for layer in self.layers:
+                if layer.visible:
+                    store = layer.tiles
+                    for row, st in enumerate(store.state):
+                        if st & TILE_SOLID:
+                            tiles.append(store.handle(row, cache=False))
+            self._solid_tiles = (tiles, self.tiles_version)
         return tiles
 
     def get_all_npcs(self):
-        npcs = pygame.sprite.Group()
-        for layer in self.layers:
-            if layer.visible:
-                for n in layer.npcs:
-                    npcs.add(n)
+        npcs, version = self._npcs
+        if version != self.npcs_version:
+            npcs = []
+            for layer in self.layers:
+                if layer.visible:
+                    npcs.extend(layer.npcs)
+            self._npcs = (npcs, self.npcs_version)
         return npcs
 
 class Level:
@@ -768,84 +2352,788 @@ class Level:
 # ========================
 # FILE I/O (SMBX binary)
 # ========================
-def read_lvl(filename):
+def build_lvl_section(reader):
+    return build_section(parse_section(reader))
+
+class LazySections:
+    # Stands in for Level.sections when a level is read lazily: a section is
+    # decoded and built the first time it is indexed (switch_section, warps)
+    # and sections never visited cost only their SectionIndex entry. build
+    # turns a reader positioned at a section's offset into a Section.
+    def __init__(self, data, index, build=build_lvl_section):
+        self.data = data  # file bytes or a read-only mmap
+        self.index = index
+        self.build = build
+        self.built = [None] * len(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        section = self.built[idx]
+        if section is None:
+            reader = LvlReader(self.data)
+            reader.pos = self.index[idx].offset
+            section = self.built[idx] = self.build(reader)
+            del reader
+            if None not in self.built and not any(s.stream for s in self.built):
+                self.release()  # streamed sections keep reading the file
+        return section
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def is_loaded(self, idx):
+        return self.built[idx] is not None
+
+    def release(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+def build_section(raw):
+    section = Section()
+    section.width = raw.width
+    section.height = raw.height
+    section.bg_color = raw.bg_color
+    section.music = raw.music
+    # Fill layers before attaching them so the section is notified once per
+    # layer rather than once per object.
+    layers = [Layer("Layer 1")]
+    def layer_at(idx):
+        check_layer(idx)
+        while len(layers) <= idx:
+            layers.append(Layer(f"Layer {len(layers)+1}"))
+        return layers[idx]
+
+    tile_names = TILE_ID_TO_NAME
+    tiles_by_layer = {}
+    for x, y, type_id, layer, event_id, flags in raw.blocks:
+        if type_id in tile_names:
+            tiles_by_layer.setdefault(layer, []).append((x, y, type_id, event_id, flags))
+    for layer, records in tiles_by_layer.items():
+        layer_at(layer).tiles.extend(records)
+    bgo_names = BGO_ID_TO_NAME
+    for x, y, type_id, layer, flags in raw.bgos:
+        name = bgo_names.get(type_id)
+        if name is not None:
+            layer_at(layer).bgos.add(BGO(x, y, name, layer, flags=flags))
+    npc_names = NPC_ID_TO_NAME
+    for x, y, type_id, layer, event_id, flags, direction, special in raw.npcs:
+        name = npc_names.get(type_id)
+        if name is not None:
+            layer_at(layer).npcs.add(NPC(x, y, name, layer, event_id, flags,
+                                         direction=1 if direction else -1, special_data=special))
+    for name, trigger, actions in raw.events:
+        section.events.append(Event(name, trigger, actions))
+
+    section.layers = []
+    for layer in layers:
+        section.add_layer(layer)
+    return section
+
+def read_lvl(filename, lazy=False, use_mmap=False, cache=False, stream=False):
+    # Raises OSError if the file can't be read and LevelFormatError if it is
+    # not a well-formed level. With lazy=True only the starting section is
+    # built up front; use_mmap additionally maps the file instead of reading
+    # it, so unvisited sections are never even paged in. With cache=True the
+    # level is loaded from its compiled sidecar (see LEVEL CACHE), which is
+    # written or rebuilt first if missing or stale. With stream=True a level
+    # with any section at least STREAM_MIN_WIDTH wide is read lazily from a
+    # mapped file and those sections are streamed (see SECTION STREAMING);
+    # other levels load as the remaining options say.
+    if stream:
+        level = read_streamed_lvl(filename)
+        if level is not None:
+            return level
+    if cache:
+        return read_cached_lvl(filename, lazy, use_mmap)
     level = Level()
-    try:
-        with open(filename, 'rb') as f:
-            magic = f.read(4)
-            if magic != b'LVL\x1a':
-                print("Not a valid SMBX level file")
-                return level
-            version = struct.unpack('<I', f.read(4))[0]
-            level.name = f.read(32).decode('utf-8', errors='ignore').strip('\x00')
-            level.author = f.read(32).decode('utf-8', errors='ignore').strip('\x00')
-            level.time_limit = struct.unpack('<I', f.read(4))[0]
-            level.stars = struct.unpack('<I', f.read(4))[0]
-            flags = struct.unpack('<I', f.read(4))[0]
-            level.no_background = bool(flags & 1)
-            f.read(128-4-4-32-32-4-4-4)
-
-            num_sections = struct.unpack('<I', f.read(4))[0]
-            level.sections = []
-            for s in range(num_sections):
-                section = Section()
-                section.width = struct.unpack('<I', f.read(4))[0]
-                section.height = struct.unpack('<I', f.read(4))[0]
-                bg_r, bg_g, bg_b = struct.unpack('<BBB', f.read(3))
-                section.bg_color = (bg_r, bg_g, bg_b)
-                f.read(1)
-                section.music = struct.unpack('<I', f.read(4))[0]
-
-                num_blocks = struct.unpack('<I', f.read(4))[0]
-                for _ in range(num_blocks):
-                    x, y, type_id, layer, event_id, flags = struct.unpack('<IIIIII', f.read(24))
-                    if type_id in TILE_ID_TO_NAME:
-                        tile = Tile(x, y, TILE_ID_TO_NAME[type_id], layer, event_id, flags)
-                        while len(section.layers) <= layer:
-                            section.layers.append(Layer(f"Layer {len(section.layers)+1}"))
-                        section.layers[layer].add_tile(tile)
-
-                num_bgos = struct.unpack('<I', f.read(4))[0]
-                for _ in range(num_bgos):
-                    x, y, type_id, layer, flags = struct.unpack('<IIIII', f.read(20))
-                    if type_id in BGO_ID_TO_NAME:
-                        bgo = BGO(x, y, BGO_ID_TO_NAME[type_id], layer, flags=flags)
-                        while len(section.layers) <= layer:
-                            section.layers.append(Layer(f"Layer {len(section.layers)+1}"))
-                        section.layers[layer].bgos.add(bgo)
-
-                num_npcs = struct.unpack('<I', f.read(4))[0]
-                for _ in range(num_npcs):
-                    data = struct.unpack('<IIIIIIII', f.read(32))
-                    x, y, type_id, layer, event_id, flags, direction, special = data
-                    if type_id in NPC_ID_TO_NAME:
-                        npc = NPC(x, y, NPC_ID_TO_NAME[type_id], layer, event_id, flags,
-                                  direction=1 if direction else -1, special_data=special)
-                        while len(section.layers) <= layer:
-                            section.layers.append(Layer(f"Layer {len(section.layers)+1}"))
-                        section.layers[layer].npcs.add(npc)
-
-                num_warps = struct.unpack('<I', f.read(4))[0]
-                for _ in range(num_warps):
-                    warp_data = f.read(64)  # parse if needed
-                    # For simplicity, we skip
-                num_events = struct.unpack('<I', f.read(4))[0]
-                for _ in range(num_events):
-                    name_len = struct.unpack('<B', f.read(1))[0]
-                    name = f.read(name_len).decode('utf-8')
-                    trigger = struct.unpack('<I', f.read(4))[0]
-                    action_count = struct.unpack('<I', f.read(4))[0]
-                    actions = []
-                    for _ in range(action_count):
-                        act_type, target, value = struct.unpack('<III', f.read(12))
-                        actions.append((act_type, target, value))
-                    section.events.append(Event(name, trigger, actions))
-
-                level.sections.append(section)
-    except Exception as e:
-        print("Load error:", e)
+    with open(filename, 'rb') as f:
+        if lazy and use_mmap:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise LevelFormatError("empty level file")
+        else:
+            data = f.read()
+    reader = LvlReader(data)
+    parse_lvl_header(reader, level)
+    num_sections = reader.count("section")
+    if lazy:
+        index = [index_section(reader) for _ in range(num_sections)]
+        del reader  # the memoryview would keep an mmap from closing
+        level.sections = LazySections(data, index)
+        if num_sections:
+            level.current_section()
+        return level
+    # Decode every record table first; objects are built once the whole file
+    # is known to be well-formed.
+    raw_sections = [parse_section(reader) for _ in range(num_sections)]
+    level.sections = [build_section(raw) for raw in raw_sections]
     return level
 
+# ========================
+# SECTION STREAMING
+# ========================
+# Very wide sections (auto-generated endurance levels run to hundreds of
+# screens) are not built whole. Their record tables stay in the mapped level
+# file; one pass over the x column sorts record numbers into STREAM_CHUNK
+# wide columns, and only the chunks around the camera have tiles, BGOs and
+# NPCs in the section's layers. A chunk that falls STREAM_KEEP chunks behind
+# the loaded range is evicted, keeping what the player did to it: tiles
+# collected or broken, tiles that changed type, NPCs killed. Only NPCs that
+# NPCActivation has put to sleep are evicted; a sleeping placed NPC is at its
+# spawn point, which is where it is rebuilt. Awake NPCs (spawned ones
+# included) are left to its timeout, and the chunks they can reach stay
+# loaded, so they see the same tiles wherever the camera goes. Replays record
+# whether they were made streamed and play back the same way.
+STREAM_CHUNK = 32 * GRID_SIZE                   # chunk width in pixels
+STREAM_MIN_WIDTH = 64 * STREAM_CHUNK            # narrower sections are built whole
+STREAM_MARGIN = ACTIVATION_MARGIN + STREAM_CHUNK  # loaded this far beyond the view
+STREAM_KEEP = 2                                 # chunks kept past that before eviction
+STREAM_COMPACT_MIN = 4096                       # dead tile rows before a layer is compacted
+PSWITCH_SWAP = {TILE_SMBX_IDS['coin']: TILE_SMBX_IDS['brick'],
+                TILE_SMBX_IDS['brick']: TILE_SMBX_IDS['coin']}
+
+class StreamChunk:
+    __slots__ = ('blocks', 'bgos', 'npcs', 'gone', 'retyped', 'dead', 'rows', 'objects', 'rect')
+
+    def __init__(self):
+        self.blocks = array('I')  # record numbers anchored in this chunk
+        self.bgos = array('I')
+        self.npcs = array('I')
+        self.gone = set()     # block records removed during play
+        self.retyped = {}     # block record -> type id it was changed to
+        self.dead = set()     # NPC records killed during play
+        self.rows = {}        # while loaded: layer index -> (rows, block records)
+        self.objects = []     # while loaded: its BGOs
+        self.rect = None
+
+class SectionStream:
+    def __init__(self, section, data, tables):
+        self.section = section
+        self.data = data      # the mapped level file, kept open
+        self.tables = tables  # (offset, count) of the block, BGO and NPC tables
+        self.chunks = {}      # chunk index -> StreamChunk, only chunks with records
+        self.loaded = set()
+        self.resident = {}    # NPC record -> NPC built from it, while in a layer
+        top = 0
+        for table, st, slot in zip(tables, (BLOCK_RECORD, BGO_RECORD, NPC_RECORD),
+                                   ('blocks', 'bgos', 'npcs')):
+            top = max(top, self._bin(table, st, slot))
+        section.layer_at(check_layer(top))
+
+    def _bin(self, table, st, slot):
+        # Sorts a table's record numbers into chunks by x; returns the
+        # highest layer index it uses.
+        offset, count = table
+        chunks = self.chunks
+        with memoryview(self.data)[offset:offset + count * st.size] as raw:
+            if sys.byteorder == 'little' and array('I').itemsize == 4:
+                with raw.cast('I') as words:
+                    fields = st.size // 4
+                    xs, layers = words[0::fields].tolist(), words[3::fields].tolist()
+            else:
+                records = list(st.iter_unpack(raw))
+                xs, layers = [r[0] for r in records], [r[3] for r in records]
+        bins = {}
+        for i, x in enumerate(xs):
+            k = x // STREAM_CHUNK
+            numbers = bins.get(k)
+            if numbers is None:
+                numbers = bins[k] = array('I')
+            numbers.append(i)
+        for k, numbers in bins.items():
+            chunk = chunks.get(k)
+            if chunk is None:
+                chunk = chunks[k] = StreamChunk()
+            setattr(chunk, slot, numbers)
+        return max(layers, default=0)
+
+    def update(self, view):
+        lo = (view.left - STREAM_MARGIN) // STREAM_CHUNK
+        hi = (view.right - 1 + STREAM_MARGIN) // STREAM_CHUNK
+        wanted = set(range(lo, hi + 1))
+        # Awake NPCs keep the tiles they can reach this tick loaded wherever
+        # the camera goes (after a respawn or an edge teleport, say).
+        for npc in self.section.activation.active:
+            wanted.update(range((npc.rect.left - GRID_SIZE) // STREAM_CHUNK,
+                                (npc.rect.right + GRID_SIZE) // STREAM_CHUNK + 1))
+        for k in sorted(wanted):
+            if k in self.chunks and k not in self.loaded:
+                self.load(k)
+        far = [k for k in sorted(self.loaded) if k not in wanted
+               and (k < lo - STREAM_KEEP or k > hi + STREAM_KEEP)]
+        if far:
+            zone = view.inflate(2 * ACTIVATION_MARGIN, 2 * ACTIVATION_MARGIN)
+            for k in far:
+                self.evict(k, zone)
+            self.compact()
+
+    def load(self, k):
+        chunk = self.chunks[k]
+        section, data = self.section, self.data
+        swap = PSWITCH_SWAP if section.pswitch_timer else {}
+        offset, size = self.tables[0][0], BLOCK_RECORD.size
+        per_layer = {}
+        top, bottom = 0, 0
+        for i in chunk.blocks:
+            if i in chunk.gone:
+                continue
+            x, y, type_id, layer, event_id, flags = BLOCK_RECORD.unpack_from(data, offset + i * size)
+            if type_id not in TILE_ID_TO_NAME:
+                continue
+            type_id = chunk.retyped.get(i, type_id)
+            type_id = swap.get(type_id, type_id)
+            records, numbers = per_layer.setdefault(layer, ([], array('I')))
+            records.append((x, y, type_id, event_id, flags))
+            numbers.append(i)
+            top, bottom = min(top, y), max(bottom, y + GRID_SIZE)
+        for layer, (records, numbers) in per_layer.items():
+            store = section.layers[layer].tiles
+            start = len(store.xs)
+            store.extend(records)
+            chunk.rows[layer] = (array('i', range(start, start + len(records))), numbers)
+        offset, size = self.tables[1][0], BGO_RECORD.size
+        for i in chunk.bgos:
+            x, y, type_id, layer, flags = BGO_RECORD.unpack_from(data, offset + i * size)
+            name = BGO_ID_TO_NAME.get(type_id)
+            if name is not None:
+                bgo = BGO(x, y, name, layer, flags=flags)
+                section.layers[layer].bgos.add(bgo)
+                chunk.objects.append(bgo)
+        offset, size = self.tables[2][0], NPC_RECORD.size
+        for i in chunk.npcs:
+            npc = self.resident.get(i)
+            if npc is not None:
+                if npc.alive():
+                    continue  # wandered out of its chunk and was kept
+                del self.resident[i]
+                chunk.dead.add(i)
+            if i in chunk.dead:
+                continue
+            x, y, type_id, layer, event_id, flags, direction, special = NPC_RECORD.unpack_from(
+                data, offset + i * size)
+            name = NPC_ID_TO_NAME.get(type_id)
+            if name is not None:
+                npc = NPC(x, y, name, layer, event_id, flags,
+                          direction=1 if direction else -1, special_data=special)
+                self.resident[i] = npc
+                section.layers[layer].npcs.add(npc)
+        # Tiles reach one cell past their anchor
+        chunk.rect = pygame.Rect(k * STREAM_CHUNK, top, STREAM_CHUNK + GRID_SIZE,
+                                 bottom - top + GRID_SIZE)
+        section.changed('tiles', chunk.rect)
+        self.loaded.add(k)
+
+    def evict(self, k, zone):
+        # NPCs from this chunk that are awake, or about to wake in `zone`,
+        # stay until they die or their chunk is reloaded.
+        chunk = self.chunks[k]
+        section, data = self.section, self.data
+        unswap = PSWITCH_SWAP if section.pswitch_timer else {}
+        offset, size = self.tables[0][0], BLOCK_RECORD.size
+        for layer, (rows, numbers) in chunk.rows.items():
+            store = section.layers[layer].tiles
+            state, types = store.state, store.types
+            for row, i in zip(rows, numbers):
+                if row < 0 or not state[row] & TILE_ALIVE:
+                    chunk.gone.add(i)
+                    continue
+                type_id = types[row]
+                type_id = unswap.get(type_id, type_id)
+                if type_id != BLOCK_RECORD.unpack_from(data, offset + i * size)[2]:
+                    chunk.retyped[i] = type_id
+                else:
+                    chunk.retyped.pop(i, None)
+                store.remove_row(row, notify=False)
+        chunk.rows = {}
+        for bgo in chunk.objects:
+            bgo.kill()
+        chunk.objects = []
+        awake = section.activation.active
+        for i in chunk.npcs:
+            npc = self.resident.get(i)
+            if npc is None:
+                continue
+            if npc.dead or not npc.alive():
+                chunk.dead.add(i)
+            elif npc in awake or zone.colliderect(npc.rect):
+                continue
+            del self.resident[i]
+            npc.kill()
+        section.changed('tiles', chunk.rect)
+        self.loaded.discard(k)
+
+    def compact(self):
+        # Evicted and collected tiles leave tombstoned rows; once a layer has
+        # enough of them, renumber it and the loaded chunks' row lists.
+        renumbered = False
+        for index, layer in enumerate(self.section.layers):
+            store = layer.tiles
+            if len(store.xs) - store.live < max(STREAM_COMPACT_MIN, store.live):
+                continue
+            remap = store.compact()
+            for k in self.loaded:
+                chunk = self.chunks[k]
+                if index in chunk.rows:
+                    rows, numbers = chunk.rows[index]
+                    chunk.rows[index] = (array('i', [remap[row] for row in rows]), numbers)
+            renumbered = True
+        if renumbered:
+            self.section.changed('rows')
+
+def build_streamed_section(reader, data):
+    # A Section whose objects stay in `data` until SectionStream loads them;
+    # narrow sections are built whole as usual.
+    if SECTION_HEADER.unpack_from(reader.buf, reader.pos)[0] < STREAM_MIN_WIDTH:
+        return build_lvl_section(reader)
+    width, height, bg_r, bg_g, bg_b, music = reader.unpack(SECTION_HEADER, "section header")
+    tables = []
+    for st, what in ((BLOCK_RECORD, "block"), (BGO_RECORD, "BGO"), (NPC_RECORD, "NPC")):
+        tables.append((reader.pos + U32.size, reader.skip_table(st.size, what)))
+    reader.skip_table(WARP_RECORD_SIZE, "warp")
+    section = Section()
+    section.width, section.height = width, height
+    section.bg_color = (bg_r, bg_g, bg_b)
+    section.music = music
+    for name, trigger, actions in parse_events(reader):
+        section.events.append(Event(name, trigger, actions))
+    section.stream = SectionStream(section, data, tables)
+    return section
+
+def read_streamed_lvl(filename):
+    # The level with its wide sections streamed, or None if it has none.
+    level = Level()
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise LevelFormatError("empty level file")
+    reader = LvlReader(data)
+    parse_lvl_header(reader, level)
+    index = [index_section(reader) for _ in range(reader.count("section"))]
+    del reader  # the memoryview would keep the mmap from closing
+    if all(entry.width < STREAM_MIN_WIDTH for entry in index):
+        data.close()
+        return None
+    level.sections = LazySections(data, index, build=lambda reader: build_streamed_section(reader, data))
+    level.current_section()
+    return level
+
+# ========================
+# LEVEL CACHE
+# ========================
+# A compiled copy of a level kept next to it (level.lvl -> level.lvlc), like
+# a .pyc. It holds the level's own 128-byte header, a section index, a table
+# of the BGO/NPC type names the level uses, and per section: every layer's
+# tile columns and bucket table exactly as TileStore keeps them, BGO and NPC
+# records with unknown types dropped and names resolved, and the events.
+# Loading a layer's tiles is a few array.frombytes() calls instead of
+# decoding, filtering and bucketing every block. The cache is keyed on the
+# source's size and mtime, falling back to a content hash when only the
+# mtime differs (a fresh checkout or copy; the new mtime is then written
+# back), and is tied to this build's layout and ID tables; anything else,
+# including a body that fails its CRC, rebuilds it. Writes go through a temp
+# file and os.replace(), so a reader never sees a half-written cache.
+CACHE_SUFFIX = 'c'
+CACHE_MAGIC = b'SMBXLVC2'
+CACHE_HEADER = struct.Struct('<8s8sIQq16sQI')  # magic, layout, schema, source size, mtime_ns, digest, body size, body crc32
+CACHE_SECTION = struct.Struct('<QIIIIIII')    # SectionIndex: offset, width, height, record counts
+CACHE_SECTION_HEADER = struct.Struct('<IIBBBxIIII')  # width, height, bg r/g/b, music, layers, bgos, npcs
+CACHE_TILES = struct.Struct('<II')            # tile rows, buckets
+CACHE_BGO = struct.Struct('<IIHHI')           # x, y, name, layer, flags
+CACHE_NPC = struct.Struct('<IIHHIIbI')        # x, y, name, layer, event, flags, direction, special
+TILE_COLUMNS = 'qqHqIB'                       # TileStore xs, ys, types, events, flags, state
+# Native byte order and item sizes: caches are not portable between builds
+# where these differ.
+CACHE_LAYOUT = (sys.byteorder[0] + ''.join(str(array(c).itemsize) for c in TILE_COLUMNS + 'i')).encode().ljust(8, b'\0')
+CACHE_SCHEMA = zlib.crc32(repr((sorted(TILE_ID_TO_NAME.items()), sorted(BGO_ID_TO_NAME.items()),
+                                sorted(NPC_ID_TO_NAME.items()), sorted(NON_SOLID_TILE_IDS),
+                                TILE_BUCKET)).encode())
+
+def cache_path(filename):
+    return filename + CACHE_SUFFIX
+
+def source_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def compile_section(raw, name_id):
+    tiles_by_layer = {}
+    top = 0
+    tile_names = TILE_ID_TO_NAME
+    for x, y, type_id, layer, event_id, flags in raw.blocks:
+        if type_id in tile_names:
+            tiles_by_layer.setdefault(layer, []).append((x, y, type_id, event_id, flags))
+            top = max(top, check_layer(layer))
+    bgos = bytearray()
+    nbgos = 0
+    bgo_names = BGO_ID_TO_NAME
+    for x, y, type_id, layer, flags in raw.bgos:
+        name = bgo_names.get(type_id)
+        if name is not None:
+            bgos += CACHE_BGO.pack(x, y, name_id(name), layer, flags)
+            top = max(top, check_layer(layer))
+            nbgos += 1
+    npcs = bytearray()
+    nnpcs = 0
+    npc_names = NPC_ID_TO_NAME
+    for x, y, type_id, layer, event_id, flags, direction, special in raw.npcs:
+        name = npc_names.get(type_id)
+        if name is not None:
+            npcs += CACHE_NPC.pack(x, y, name_id(name), layer, event_id, flags,
+                                   1 if direction else -1, special)
+            top = max(top, check_layer(layer))
+            nnpcs += 1
+
+    out = bytearray(CACHE_SECTION_HEADER.pack(raw.width, raw.height, *raw.bg_color, raw.music,
+                                              top + 1, nbgos, nnpcs))
+    for layer in range(top + 1):
+        # Bucket through a scratch store so row order and buckets match what
+        # build_section() would produce; buckets are written in key order.
+        store = TileStore()
+        store.extend(tiles_by_layer.get(layer, ()))
+        keys = sorted(store.buckets)
+        ends = array('i')
+        rows = array('i')
+        for key in keys:
+            rows.extend(store.buckets[key])
+            ends.append(len(rows))
+        out += CACHE_TILES.pack(len(store.xs), len(keys))
+        for col in (store.xs, store.ys, store.types, store.events, store.flags, store.state,
+                    array('q', keys), ends, rows):
+            out += col.tobytes()
+    out += bgos
+    out += npcs
+    out += encode_events(raw.events)
+    return out
+
+def compile_lvl(data, stat):
+    # Parses a whole level file and returns its cache image. Raises
+    # LevelFormatError exactly where read_lvl() would.
+    reader = LvlReader(data)
+    parse_lvl_header(reader, Level())
+    raw_sections = [parse_section(reader) for _ in range(reader.count("section"))]
+    names = []
+    name_ids = {}
+    def name_id(name):
+        idx = name_ids.get(name)
+        if idx is None:
+            idx = name_ids[name] = len(names)
+            names.append(name)
+        return idx
+    bodies = [compile_section(raw, name_id) for raw in raw_sections]
+
+    name_table = bytearray(U32.pack(len(names)))
+    for name in names:
+        encoded = name.encode('utf-8')
+        name_table += U8.pack(len(encoded)) + encoded
+    body = bytearray(bytes(data[:LVL_HEADER_SIZE]))
+    body += U32.pack(len(bodies))
+    offset = CACHE_HEADER.size + len(body) + len(bodies) * CACHE_SECTION.size + len(name_table)
+    for raw, section in zip(raw_sections, bodies):
+        body += CACHE_SECTION.pack(offset, raw.width, raw.height, len(raw.blocks), len(raw.bgos),
+                                   len(raw.npcs), raw.warps, len(raw.events))
+        offset += len(section)
+    body += name_table
+    for section in bodies:
+        body += section
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_LAYOUT, CACHE_SCHEMA, stat.st_size,
+                               stat.st_mtime_ns, source_digest(data), len(body), zlib.crc32(body))
+    return header + body
+
+def build_cached_section(reader, names):
+    width, height, bg_r, bg_g, bg_b, music, nlayers, nbgos, nnpcs = reader.unpack(
+        CACHE_SECTION_HEADER, "cached section header")
+    section = Section()
+    section.width = width
+    section.height = height
+    section.bg_color = (bg_r, bg_g, bg_b)
+    section.music = music
+    layers = [Layer(f"Layer {i+1}") for i in range(nlayers)]
+    for layer in layers:
+        rows, nbuckets = reader.unpack(CACHE_TILES, "cached tile table")
+        columns = tuple(reader.column(c, rows, "tile column items") for c in TILE_COLUMNS)
+        keys = reader.column('q', nbuckets, "bucket keys")
+        ends = reader.column('i', nbuckets, "bucket ends")
+        bucket_rows = reader.column('i', rows, "bucket rows")
+        buckets = {}
+        start = 0
+        for key, end in zip(keys, ends):
+            buckets[key] = bucket_rows[start:end]
+            start = end
+        layer.tiles.load_columns(columns, buckets)
+    reader.need(nbgos * CACHE_BGO.size, f"{nbgos} cached BGO records")
+    end = reader.pos + nbgos * CACHE_BGO.size
+    for x, y, name, layer, flags in CACHE_BGO.iter_unpack(reader.buf[reader.pos:end]):
+        layers[layer].bgos.add(BGO(x, y, names[name], layer, flags=flags))
+    reader.pos = end
+    reader.need(nnpcs * CACHE_NPC.size, f"{nnpcs} cached NPC records")
+    end = reader.pos + nnpcs * CACHE_NPC.size
+    for x, y, name, layer, event_id, flags, direction, special in CACHE_NPC.iter_unpack(
+            reader.buf[reader.pos:end]):
+        layers[layer].npcs.add(NPC(x, y, names[name], layer, event_id, flags,
+                                   direction=direction, special_data=special))
+    reader.pos = end
+    for name, trigger, actions in parse_events(reader):
+        section.events.append(Event(name, trigger, actions))
+
+    section.layers = []
+    for layer in layers:
+        section.add_layer(layer)
+    return section
+
+def load_compiled(data, lazy=False):
+    reader = LvlReader(data)
+    reader.pos = CACHE_HEADER.size
+    level = Level()
+    parse_lvl_header(reader, level)
+    num_sections = reader.count("section")
+    index = [SectionIndex(*reader.unpack(CACHE_SECTION, "cached section index"))
+             for _ in range(num_sections)]
+    names = [reader.bytes(reader.unpack(U8, "type name length")[0], "type name").decode('utf-8')
+             for _ in range(reader.count("type name"))]
+    build = lambda reader: build_cached_section(reader, names)
+    if lazy:
+        del reader
+        level.sections = LazySections(data, index, build)
+        if num_sections:
+            level.current_section()
+        return level
+    sections = []
+    for entry in index:
+        reader.pos = entry.offset
+        sections.append(build(reader))
+    level.sections = sections
+    return level
+
+def open_cache(filename, stat, use_mmap=False):
+    # The cache image for filename if it exists and is current, else None.
+    try:
+        with open(cache_path(filename), 'rb') as f:
+            header = f.read(CACHE_HEADER.size)
+            if len(header) < CACHE_HEADER.size:
+                return None
+            magic, layout, schema, size, mtime, digest, body_size, crc = CACHE_HEADER.unpack(header)
+            if (magic, layout, schema, size) != (CACHE_MAGIC, CACHE_LAYOUT, CACHE_SCHEMA, stat.st_size):
+                return None
+            if os.fstat(f.fileno()).st_size != CACHE_HEADER.size + body_size:
+                return None  # truncated by something other than us
+            if use_mmap and mtime == stat.st_mtime_ns:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                f.seek(0)
+                data = f.read()
+    except OSError:
+        return None
+    if zlib.crc32(memoryview(data)[CACHE_HEADER.size:]) != crc:
+        return None  # damaged in place
+    if mtime != stat.st_mtime_ns:
+        with open(filename, 'rb') as src:
+            if source_digest(src.read()) != digest:
+                return None
+        # Same content under a new mtime: record it so the next load skips
+        # the hash.
+        data = bytearray(data)
+        CACHE_HEADER.pack_into(data, 0, magic, layout, schema, size, stat.st_mtime_ns,
+                               digest, body_size, crc)
+        write_cache(filename, data)
+    return data
+
+def write_cache(filename, data):
+    path = cache_path(filename)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        # A read-only level directory just means no cache next time.
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def read_cached_lvl(filename, lazy=False, use_mmap=False):
+    stat = os.stat(filename)
+    data = open_cache(filename, stat, lazy and use_mmap)
+    if data is not None:
+        try:
+            return load_compiled(data, lazy)
+        except LevelFormatError:
+            pass  # passed its checks but doesn't parse; rebuild it
+    with open(filename, 'rb') as f:
+        source = f.read()
+    data = compile_lvl(source, stat)
+    write_cache(filename, data)
+    return load_compiled(data, lazy)
+
+# ========================
+# FRAME PROFILER
+# ========================
+FRAME_PHASES = ('events', 'collections', 'player', 'npcs', 'warps', 'camera',
+                'activation', 'draw', 'flip', 'wait')
+
+class FrameProfiler:
+    # Per-phase frame timings in a fixed-size ring buffer. Every entry point
+    # returns immediately while disabled, so the instrumented loop pays one
+    # attribute check per phase.
+    def __init__(self, phases=FRAME_PHASES, capacity=600):
+        self.phases = phases
+        self.index = {p: i for i, p in enumerate(phases)}
+        self.capacity = capacity
+        self.enabled = False
+        self.overlay = False
+        self.frames = 0  # frames recorded so far; slot = frames % capacity
+        self.frame_start = array('d', bytes(8 * capacity))
+        self.offsets = [array('d', bytes(8 * capacity)) for _ in phases]
+        self.durations = [array('d', bytes(8 * capacity)) for _ in phases]
+        self._last = 0.0
+        self._profile = None
+        self._profile_left = 0
+        self._profile_path = None
+        self._was_enabled = False  # restored when a capture finishes
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        slot = self.frames % self.capacity
+        for d in self.durations:
+            d[slot] = 0.0
+        if self._profile_left and self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._last = self.frame_start[slot] = time.perf_counter()
+
+    def mark(self, phase):
+        # Attribute the time since the previous mark to `phase`.
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        slot = self.frames % self.capacity
+        i = self.index[phase]
+        if not self.durations[i][slot]:
+            self.offsets[i][slot] = self._last - self.frame_start[slot]
+        self.durations[i][slot] += now - self._last
+        self._last = now
+
+    def end_frame(self):
+        if not self.enabled:
+            if self._profile is not None:
+                self._capture_frame()  # a running capture still finishes
+            return
+        self.frames += 1
+        if self._profile is not None:
+            self._capture_frame()
+
+    def _capture_frame(self):
+        self._profile_left -= 1
+        if self._profile_left <= 0:
+            self._profile.disable()
+            self._profile.dump_stats(self._profile_path)
+            print("Frame profile written to", self._profile_path)
+            self._profile = None
+            self.enabled = self._was_enabled
+
+    def capture_profile(self, frames, path="frame_profile.prof"):
+        # cProfile the next `frames` frames and dump pstats to `path`; timing
+        # stays on until then and goes back to how it was afterwards.
+        if not self._profile_left:
+            self._was_enabled = self.enabled
+        self.enabled = True
+        self._profile_left = frames
+        self._profile_path = path
+
+    def set_enabled(self, enabled):
+        # During a capture this only decides the state it ends in.
+        if self._profile_left:
+            self._was_enabled = enabled
+        else:
+            self.enabled = enabled
+
+    def _recent_slots(self, frames=None):
+        n = min(self.frames, self.capacity, frames or self.capacity)
+        return [(self.frames - n + k) % self.capacity for k in range(n)]
+
+    def stats(self, frames=None):
+        # {phase: (avg_ms, p95_ms, max_ms)} over the last `frames` frames.
+        slots = self._recent_slots(frames)
+        result = {}
+        if not slots:
+            return result
+        for phase, d in zip(self.phases, self.durations):
+            values = sorted(d[s] * 1000.0 for s in slots)
+            result[phase] = (sum(values) / len(values),
+                             values[int(0.95 * (len(values) - 1))], values[-1])
+        return result
+
+    def export_trace(self, path="frame_trace.json", frames=None):
+        # Chrome trace (chrome://tracing, Perfetto) of the last `frames` frames.
+        events = []
+        for slot in self._recent_slots(frames):
+            start = self.frame_start[slot]
+            total = 0.0
+            for phase, offs, durs in zip(self.phases, self.offsets, self.durations):
+                if durs[slot]:
+                    events.append({'name': phase, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': 1,
+                                   'ts': (start + offs[slot]) * 1e6, 'dur': durs[slot] * 1e6})
+                    total = max(total, offs[slot] + durs[slot])
+            events.append({'name': 'frame', 'cat': 'frame', 'ph': 'X', 'pid': 1, 'tid': 0,
+                           'ts': start * 1e6, 'dur': total * 1e6})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+    def draw_overlay(self, surf, pos):
+        stats = self.stats(FPS * 2)
+        x, y = pos
+        panel = pygame.Rect(x - 4, y - 4, 250, 18 * (len(stats) + 1) + 8)
+        surf.fill((0,0,0), panel)
+        draw_text(surf, "phase       avg   p95   max ms", (x, y), YELLOW, get_font(FONT_SMALL))
+        for phase, (avg, p95, worst) in stats.items():
+            y += 18
+            draw_text(surf, f"{phase:<10}{avg:6.2f}{p95:6.2f}{worst:6.2f}", (x, y), WHITE, get_font(FONT_SMALL))
+        return panel
+
+# ========================
+# DIRTY RECTANGLES
+# ========================
+class DirtyRects:
+    # Lets a frame push only the screen rects that changed with
+    # display.update() instead of flipping the whole window. Sprites, HUD and
+    # overlays are drawn every frame; the background is only repainted where
+    # something was drawn last frame or a chunk was rebaked. Anything that
+    # shifts the whole picture - camera scroll, section switch, new art, a
+    # window expose - changes the key (or sets `full`) and gets a full frame.
+    def __init__(self):
+        self.key = None
+        self.full = True
+        self.drawn = []    # screen rects drawn over the background last frame
+        self.repaint = []
+
+    def needs_full(self, key):
+        if key != self.key:
+            self.key = key
+            self.full = True
+        full, self.full = self.full, False
+        return full
+
+    def restore(self, damage):
+        # Rects to repaint the background in before drawing this frame.
+        self.repaint = self.drawn + damage
+        return self.repaint
+
+    def finish(self, drawn, full):
+        # The rects to pass to display.update(), or None to flip.
+        regions = None if full else self.repaint + drawn
+        self.drawn = drawn
+        self.repaint = []
+        return regions
+
 # ========================
 # CAMERA
 # ========================
@@ -861,9 +3149,19 @@ class Camera:
         y = min(0, max(-(self.height - WINDOW_HEIGHT), y))
         self.camera = pygame.Rect(x, y, self.width, self.height)
 
+    def view(self):
+        # The part of the section on screen, in world coordinates.
+        return pygame.Rect(-self.camera.x, -self.camera.y, WINDOW_WIDTH, WINDOW_HEIGHT)
+
 # ========================
 # GAME ENGINE
 # ========================
+TICK_SECONDS = 1.0 / FPS
+MAX_CATCHUP_TICKS = 5            # ticks per frame before the backlog is dropped
+MAX_SKIPPED_FRAMES = 2           # undrawn frames in a row while catching up
+SKIP_AFTER_LATE_FRAMES = 3       # frames in a row needing catch-up before one is skipped
+INTERP_MAX_JUMP = 4 * GRID_SIZE  # moved further in a tick: teleported, don't tween
+
 class SMBXEngine:
     def __init__(self, level):
         self.level = level
@@ -875,27 +3173,45 @@ class SMBXEngine:
         self.paused = False
         self.game_over = False
         self.warp_cooldown = 0
+        self.tick = 0
+        self.keyboard = KeyboardInput()
+        self.profiler = FrameProfiler()
+        # Batched walker physics when numpy is there; None means per-object only.
+        self.walkers = WalkerBatch() if np is not None else None
+        self.actors = BroadPhase()
+        self.dirty = DirtyRects()  # None always redraws and flips the whole frame
+        self.previous = {}  # object -> position before the last step (snapshot())
+        self.recorder = None  # a Replay to append every tick to
+        self.camera.update(self.player)
+        if self.section.stream:
+            self.section.stream.update(self.camera.view())
+        self.section.activation.update(self.camera.view())
 
     def switch_section(self, idx):
         if 0 <= idx < len(self.level.sections):
+            try:
+                self.level.sections[idx]  # lazily loaded levels build it here
+            except LevelFormatError as e:
+                print("Load error:", e)
+                return
             self.level.current_section_idx = idx
             self.section = self.level.current_section()
             self.camera = Camera(self.section.width, self.section.height)
+            assets.request_section(self.section)
 
-    def check_warps(self):
+    def check_warps(self, inputs):
         if self.warp_cooldown > 0:
             self.warp_cooldown -= 1
             return
-        keys = pygame.key.get_pressed()
         for warp in self.section.warps:
             if self.player.rect.colliderect(warp.rect):
-                if warp.direction == 'down' and keys[pygame.K_DOWN]:
+                if warp.direction == 'down' and inputs.down:
                     self.warp_cooldown = 30
                     self.switch_section(warp.dest_section)
                     self.player.rect.topleft = (warp.dest_x, warp.dest_y)
                     self.player.level_start = (warp.dest_x, warp.dest_y)
                     play_sound('pipe')
-                elif warp.direction == 'up' and keys[pygame.K_UP]:
+                elif warp.direction == 'up' and inputs.up:
                     self.warp_cooldown = 30
                     self.switch_section(warp.dest_section)
                     self.player.rect.topleft = (warp.dest_x, warp.dest_y)
@@ -903,126 +3219,456 @@ class SMBXEngine:
                     play_sound('pipe')
 
     def run(self):
+        prof = self.profiler
+        assets.start()
+        assets.request_section(self.section)
+        assets.request_all()
+        sounds.start()
+        # Fixed timestep: the simulation advances in TICK_SECONDS steps
+        # however long frames take to draw, and frames show the world between
+        # the last two ticks. When behind, up to MAX_CATCHUP_TICKS run per
+        # frame (more is dropped: the game slows down rather than spiral).
+        # Only a backlog that persists, SKIP_AFTER_LATE_FRAMES frames in a row
+        # or one that hit the cap, lets up to MAX_SKIPPED_FRAMES frames in a
+        # row go undrawn; one frame made late by clock jitter is still drawn.
+        lag = 0.0
+        late = 0
+        skipped = 0
+        last = time.perf_counter()
         while self.running:
+            prof.begin_frame()
+            assets.pump()
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.running = False
+                if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED) and self.dirty:
+                    self.dirty.full = True
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_ESCAPE:
                         self.running = False
                     if event.key == pygame.K_p:
                         self.paused = not self.paused
-
-            if not self.paused and not self.game_over:
-                # Get all solid tiles from visible layers
-                solid_tiles = self.section.get_solid_tiles()
-                npc_group = self.section.get_all_npcs()
-
-                # Update player
-                result = self.player.update(solid_tiles, npc_group, self.section.events, self.section)
-                if result == 'game_over':
-                    self.game_over = True
-                elif result == 'next_section':
-                    self.switch_section(self.level.current_section_idx + 1)
-                    self.player.rect.x = 0
-                elif result == 'prev_section':
-                    self.switch_section(self.level.current_section_idx - 1)
-                    self.player.rect.x = self.section.width - self.player.rect.width
-
-                # Update NPCs
-                for npc in npc_group:
-                    npc.update(solid_tiles, self.player, self.player.fireballs, self.section.events)
-
-                # Check warps
-                self.check_warps()
-
-                # Update camera
-                self.camera.update(self.player)
+                    if event.key == pygame.K_F3:  # timing overlay
+                        prof.overlay = not prof.overlay
+                        prof.set_enabled(prof.overlay)
+                    if event.key == pygame.K_F4 and prof.frames:  # chrome trace dump
+                        print("Frame trace written to", prof.export_trace())
+                    if event.key == pygame.K_F5:  # cProfile the next 2 seconds
+                        prof.capture_profile(FPS * 2)
+            prof.mark('events')
+
+            now = time.perf_counter()
+            lag += now - last
+            last = now
+            ticks = 0
+            while lag >= TICK_SECONDS and ticks < MAX_CATCHUP_TICKS:
+                self.snapshot()  # also while paused, so nothing drifts
+                if not self.paused and not self.game_over:
+                    self.step(self.keyboard.poll(self.tick))
+                lag -= TICK_SECONDS
+                ticks += 1
+            lag = min(lag, TICK_SECONDS)
+            sounds.flush()
+
+            late = late + 1 if ticks > 1 else 0
+            if ((late >= SKIP_AFTER_LATE_FRAMES or ticks == MAX_CATCHUP_TICKS)
+                    and skipped < MAX_SKIPPED_FRAMES):
+                skipped += 1  # spend this frame's time catching up instead
+                prof.end_frame()
+                continue
+            skipped = 0
 
             # Draw everything
-            self.draw()
+            regions = self.draw(lag / TICK_SECONDS)
+            prof.mark('draw')
 
-            pygame.display.flip()
+            if regions is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update(regions)
+            prof.mark('flip')
             clock.tick(FPS)
+            prof.mark('wait')
+            prof.end_frame()
+
+    def step(self, inputs):
+        # Advance the simulation by one tick. Touches neither the display nor
+        # the clock, so it can be driven headless as fast as the CPU allows.
+        prof = self.profiler
+        # NPCs update in the section the tick started in, even if the player
+        # leaves it below. Solid tiles of visible layers, looked up by cell
+        section = self.section
+        solid_tiles = section.tile_index
+        npc_group = section.activation.active_list()
+        self.actors.update(npc_group)
+        prof.mark('collections')
+
+        # Update player
+        result = self.player.update(solid_tiles, self.actors, self.section.events, self.section, inputs)
+        if result == 'game_over':
+            self.game_over = True
+        elif result == 'next_section':
+            self.switch_section(self.level.current_section_idx + 1)
+            self.player.rect.x = 0
+        elif result == 'prev_section':
+            self.switch_section(self.level.current_section_idx - 1)
+            self.player.rect.x = self.section.width - self.player.rect.width
+        self.section.tick_pswitch()
+        prof.mark('player')
+
+        # Update NPCs
+        if self.walkers is not None:
+            self.walkers.update(npc_group, section, self.player)
+        else:
+            for npc in npc_group:
+                npc.update(solid_tiles, self.player, self.player.fireballs, self.section.events)
+        self.shell_hits(npc_group)
+        prof.mark('npcs')
+
+        # Check warps
+        self.check_warps(inputs)
+        prof.mark('warps')
+
+        # Update camera, streaming a wide section's chunks in around it
+        self.camera.update(self.player)
+        if self.section.stream:
+            self.section.stream.update(self.camera.view())
+        prof.mark('camera')
+
+        # Wake NPCs coming into range, put long-gone ones back to sleep
+        self.section.activation.update(self.camera.view())
+        # Retire this tick's dead and land its spawns
+        self.section.npc_registry.flush()
+        prof.mark('activation')
+        self.tick += 1
+        if self.recorder is not None:
+            self.recorder.record_tick(inputs, self.state_checksum())
+        return result
+
+    def shell_hits(self, npcs):
+        # Kicked shells take out whatever they run into, other shells
+        # included (and die with them).
+        shells = [npc for npc in npcs if npc.shell_speed and npc.state == 'shell' and not npc.dead]
+        if not shells:
+            return
+        self.actors.update(npcs)
+        for shell, npc in self.actors.pairs(shells):
+            if shell.dead or npc.dead or not shell.rect.colliderect(npc.rect):
+                continue
+            npc.dead = True
+            npc.death_timer = 10
+            if npc.state == 'shell':
+                shell.dead = True
+                shell.death_timer = 10
+            self.player.score += 100
+            play_sound('stomp')
 
-    def draw(self):
-        # Background
-        screen.fill(self.section.bg_color)
-
-        # Draw BGOs (background)
-        for layer in self.section.layers:
-            if layer.visible:
-                for bgo in layer.bgos:
-                    screen.blit(bgo.image, bgo.rect.move(self.camera.camera.x, self.camera.camera.y))
-
-        # Draw tiles
-        for layer in self.section.layers:
-            if layer.visible:
-                for tile in layer.tiles:
-                    screen.blit(tile.image, tile.rect.move(self.camera.camera.x, self.camera.camera.y))
-
-        # Draw NPCs
-        for layer in self.section.layers:
-            if layer.visible:
-                for npc in layer.npcs:
-                    if not npc.dead:
-                        screen.blit(npc.image, npc.rect.move(self.camera.camera.x, self.camera.camera.y))
+    def state_checksum(self):
+        # CRC32 of the state a replay has to reproduce exactly: the player,
+        # fireballs and every awake NPC. Dormant NPCs don't change.
+        p = self.player
+        parts = [PLAYER_STATE.pack(self.tick, self.level.current_section_idx, p.rect.x, p.rect.y,
+                                   p.velocity.x, p.velocity.y, p.lives, p.coins, p.score,
+                                   p.powerup_state, p.invincible, p.dead, len(p.fireballs))]
+        for fb in p.fireballs:
+            parts.append(OBJECT_STATE.pack(0, fb.rect.x, fb.rect.y, fb.velocity.x, fb.velocity.y,
+                                           fb.direction, False))
+        for npc in self.section.activation.active_list():
+            parts.append(OBJECT_STATE.pack(NPC_SMBX_IDS.get(npc.npc_type, 0), npc.rect.x,
+                                           npc.rect.y, npc.velocity.x, npc.velocity.y,
+                                           int(npc.direction), npc.dead))
+            parts.append(npc.state.encode())
+        return zlib.crc32(b''.join(parts))
+
+    def run_ticks(self, n, input_source=None):
+        # Headless: run up to n ticks (stopping early on game over) with input
+        # from input_source.poll(tick), or no buttons held if none is given.
+        idle = InputState()
+        start = self.tick
+        prof = self.profiler
+        while self.tick - start < n and not self.game_over:
+            prof.begin_frame()
+            self.step(input_source.poll(self.tick) if input_source else idle)
+            prof.end_frame()
+        return self.tick - start
+
+    def snapshot(self):
+        # Positions before the next step, for draw() to interpolate from.
+        prev = {self.camera: self.camera.camera.topleft, self.player: self.player.rect.topleft}
+        for npc in self.section.activation.active_list():
+            prev[npc] = npc.rect.topleft
+        for fb in self.player.fireballs:
+            prev[fb] = fb.rect.topleft
+        self.previous = prev
+
+    def _lerp(self, obj, x, y, alpha):
+        prev = self.previous.get(obj)
+        if prev is None or alpha >= 1:
+            return x, y
+        px, py = prev
+        if abs(x - px) > INTERP_MAX_JUMP or abs(y - py) > INTERP_MAX_JUMP:
+            return x, y  # teleported (respawn, warp): don't slide there
+        return round(px + (x - px) * alpha), round(py + (y - py) * alpha)
+
+    def draw(self, alpha=1.0):
+        # Draws the world `alpha` of the way from the last snapshot() to now
+        # (1 draws current positions). Returns the screen rects that changed,
+        # or None if the whole frame was redrawn (see DirtyRects).
+        screen = get_screen()
+        section = self.section
+        lerp = self._lerp
+        ox, oy = lerp(self.camera, self.camera.camera.x, self.camera.camera.y, alpha)
+        view = pygame.Rect(-ox, -oy, WINDOW_WIDTH, WINDOW_HEIGHT)
+        damage = section.chunks.take_damage()
+        dirty = self.dirty
+        full = (dirty is None or dirty.needs_full((section, ox, oy, image_cache.generation))
+                or damage is None)
+        if full:
+            # Background, then BGOs and tiles pre-rendered in chunks
+            self.draw_background(screen, view)
+            section.chunks.draw(screen, view)
+        else:
+            # Static camera: the rest of the screen still shows last frame
+            bounds = screen.get_rect()
+            damage = [r for r in (d.move(ox, oy).clip(bounds) for d in damage) if r]
+            for rect in dirty.restore(damage):
+                screen.set_clip(rect)
+                self.draw_background(screen, view, rect)
+                section.chunks.draw(screen, view, rect.move(view.x, view.y))
+            screen.set_clip(None)
+        drawn = []
+
+        # Draw NPCs; dormant ones are out of view by definition
+        for npc in section.activation.active_list():
+            if not npc.dead and view.colliderect(npc.rect):
+                x, y = lerp(npc, npc.rect.x, npc.rect.y, alpha)
+                drawn.append(screen.blit(npc.image, (x + ox, y + oy)))
 
         # Draw fireballs
         for fb in self.player.fireballs:
-            screen.blit(fb.image, fb.rect.move(self.camera.camera.x, self.camera.camera.y))
+            x, y = lerp(fb, fb.rect.x, fb.rect.y, alpha)
+            drawn.append(screen.blit(fb.image, (x + ox, y + oy)))
 
         # Draw player
         if self.player.invincible > 0 and (self.player.invincible // 5) % 2 == 0:
             pass  # blink
         else:
-            screen.blit(self.player.image, self.player.rect.move(self.camera.camera.x, self.camera.camera.y))
+            x, y = lerp(self.player, self.player.rect.x, self.player.rect.y, alpha)
+            drawn.append(screen.blit(self.player.image, (x + ox, y + oy)))
 
         # HUD
         hud_y = 10
-        draw_text(screen, f"Lives: {self.player.lives}  Coins: {self.player.coins}  Score: {self.player.score}", (10, hud_y))
+        drawn.append(draw_text(screen, f"Lives: {self.player.lives}  Coins: {self.player.coins}  Score: {self.player.score}", (10, hud_y)))
         if self.paused:
-            draw_text(screen, "PAUSED", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2), WHITE, font_big, center=True)
+            drawn.append(draw_text(screen, "PAUSED", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2), WHITE, get_font(FONT_BIG), center=True))
         if self.game_over:
-            draw_text(screen, "GAME OVER", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2), RED, font_big, center=True)
-            draw_text(screen, "Press ESC to quit", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2+50), WHITE, font, center=True)
+            drawn.append(draw_text(screen, "GAME OVER", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2), RED, get_font(FONT_BIG), center=True))
+            drawn.append(draw_text(screen, "Press ESC to quit", (WINDOW_WIDTH//2, WINDOW_HEIGHT//2+50), WHITE, center=True))
+        if self.profiler.overlay:
+            drawn.append(self.profiler.draw_overlay(screen, (10, hud_y + 28)))
+        return dirty.finish(drawn, full) if dirty else None
+
+    def draw_background(self, screen, view, area=None):
+        if self.level.no_background:
+            screen.fill(self.section.bg_color, area)
+        else:
+            backgrounds.draw(screen, self.section, view, area)
+
+# ========================
+# REPLAY
+# ========================
+# A replay is the level's CRC32, the RNG seed, how the level was loaded, one
+# input byte per tick and the state checksum after every tick. Playing it
+# back through the same level, load mode and code reproduces the run
+# exactly, which makes it a fixed workload for before/after performance
+# comparisons and catches any change that alters behaviour.
+PLAYER_STATE = struct.Struct('<iiiiddiiiii?i')
+OBJECT_STATE = struct.Struct('<iiiddi?')
+REPLAY_MAGIC = b'SMBXRPL2'
+REPLAY_HEADER = struct.Struct('<8sIQIHB')  # magic, level crc, seed, ticks, name length, flags
+REPLAY_STREAMED = 1  # flag: wide sections were streamed (read_lvl(stream=True))
+
+class ReplayError(ValueError):
+    pass
+
+class ReplayDesync(ReplayError):
+    def __init__(self, tick, expected, actual):
+        super().__init__(f"replay desynced at tick {tick}: "
+                         f"checksum {actual:08x}, recorded {expected:08x}")
+        self.tick = tick
+        self.expected = expected
+        self.actual = actual
+
+def level_crc(filename):
+    with open(filename, 'rb') as f:
+        return zlib.crc32(f.read())
+
+class Replay:
+    def __init__(self, level_name='', level_crc=0, seed=0, stream=False):
+        self.level_name = level_name
+        self.level_crc = level_crc
+        self.seed = seed
+        self.stream = stream
+        self.inputs = bytearray()
+        self.checksums = array('I')
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def record_tick(self, inputs, checksum):
+        self.inputs.append(inputs.to_bits())
+        self.checksums.append(checksum)
+
+    def save(self, filename):
+        name = self.level_name.encode('utf-8')
+        checksums = array('I', self.checksums)
+        if sys.byteorder != 'little':
+            checksums.byteswap()
+        with open(filename, 'wb') as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, self.level_crc, self.seed, len(self),
+                                       len(name), REPLAY_STREAMED if self.stream else 0))
+            f.write(name)
+            f.write(zlib.compress(bytes(self.inputs) + checksums.tobytes(), 9))
+
+    @classmethod
+    def load(cls, filename):
+        # Raises OSError if unreadable and ReplayError if it isn't a replay.
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if data[:8] != REPLAY_MAGIC:
+            raise ReplayError(f"{filename}: not a replay file")
+        if len(data) < REPLAY_HEADER.size:
+            raise ReplayError(f"{filename}: truncated replay header")
+        magic, crc, seed, ticks, name_len, flags = REPLAY_HEADER.unpack_from(data)
+        pos = REPLAY_HEADER.size
+        try:
+            name = data[pos:pos + name_len].decode('utf-8')
+            body = zlib.decompress(data[pos + name_len:])
+        except (UnicodeDecodeError, zlib.error) as e:
+            raise ReplayError(f"{filename}: corrupt replay ({e})") from None
+        if len(body) != ticks * 5:
+            raise ReplayError(f"{filename}: expected {ticks} ticks of data")
+        replay = cls(name, crc, seed, stream=bool(flags & REPLAY_STREAMED))
+        replay.inputs = bytearray(body[:ticks])
+        replay.checksums = array('I')
+        replay.checksums.frombytes(body[ticks:])
+        if sys.byteorder != 'little':
+            replay.checksums.byteswap()
+        return replay
+
+class ReplayInput:
+    # Input source feeding a replay's recorded buttons back in.
+    def __init__(self, replay):
+        self.states = [InputState.from_bits(bits) for bits in range(1 << len(InputState.__slots__))]
+        self.inputs = replay.inputs
+
+    def poll(self, tick):
+        return self.states[self.inputs[tick] if tick < len(self.inputs) else 0]
+
+def record_replay(filename, ticks, input_source, seed=0, stream=False):
+    # Headless recording of `ticks` ticks (fewer on game over) of a level.
+    level = read_lvl(filename, lazy=True, stream=stream)
+    replay = Replay(os.path.basename(filename), level_crc(filename), seed, stream)
+    rng.seed(seed)
+    engine = SMBXEngine(level)
+    engine.recorder = replay
+    engine.run_ticks(ticks, input_source)
+    return replay
+
+def play_replay(replay, filename, verify=True, engine_setup=None):
+    # Runs a replay headless and returns the engine. With verify, raises
+    # ReplayDesync on the first tick whose state checksum differs. Checksums
+    # are taken outside the profiler's frames, so they don't skew timings.
+    if level_crc(filename) != replay.level_crc:
+        raise ReplayError(f"{filename} is not the level {replay.level_name} was recorded on")
+    rng.seed(replay.seed)
+    engine = SMBXEngine(read_lvl(filename, lazy=True, stream=replay.stream))
+    if engine_setup:
+        engine_setup(engine)
+    source = ReplayInput(replay)
+    prof = engine.profiler
+    for tick in range(len(replay)):
+        if engine.game_over:
+            raise ReplayDesync(tick, replay.checksums[tick], 0)
+        prof.begin_frame()
+        engine.step(source.poll(engine.tick))
+        prof.end_frame()
+        if verify:
+            actual = engine.state_checksum()
+            if actual != replay.checksums[tick]:
+                raise ReplayDesync(tick, replay.checksums[tick], actual)
+    return engine
 
 # ========================
 # MAIN MENU
 # ========================
+def play_level(filename, record_to=None):
+    get_screen()  # before loading, so art is converted to the display format
+    try:
+        level = read_lvl(filename, lazy=True, cache=True, stream=True)
+    except (OSError, LevelFormatError) as e:
+        print("Load error:", e)
+        return
+    replay = None
+    if record_to:
+        seed = random.randrange(1 << 63)
+        replay = Replay(os.path.basename(filename), level_crc(filename), seed, stream=True)
+        rng.seed(seed)
+    engine = SMBXEngine(level)
+    engine.recorder = replay
+    engine.run()
+    if replay is not None:
+        replay.save(record_to)
+        print(f"Replay of {len(replay)} ticks written to", record_to)
+
 def main_menu():
     menu_items = ["Start Game (level.lvl)", "Load Level...", "Quit"]
     selected = 0
-    while True:
-        screen.fill(BLACK)
-        draw_text(screen, "AC HOLDINGS CATSAN ENGINE SMBX 1.3", (WINDOW_WIDTH//2, 100), WHITE, font_big, center=True)
-        for i, item in enumerate(menu_items):
-            color = GREEN if i == selected else WHITE
-            draw_text(screen, item, (WINDOW_WIDTH//2, 250 + i*40), color, font, center=True)
+    screen = get_screen()
+    assets.start()  # load art and sound while the menu is up
+    assets.request_all()
+    sounds.start()
 
-        pygame.display.flip()
+    def draw_item(i):
+        color = GREEN if i == selected else WHITE
+        return draw_text(screen, menu_items[i], (WINDOW_WIDTH//2, 250 + i*40), color, center=True)
+
+    shown = None  # selection on screen; None redraws the whole menu
+    while True:
+        assets.pump()
+        if shown is None:
+            screen.fill(BLACK)
+            draw_text(screen, "AC HOLDINGS CATSAN ENGINE SMBX 1.3", (WINDOW_WIDTH//2, 100), WHITE, get_font(FONT_BIG), center=True)
+            item_rects = [draw_item(i) for i in range(len(menu_items))]
+            pygame.display.flip()
+        elif shown != selected:
+            # Only the old and new highlight change
+            for i in (shown, selected):
+                screen.fill(BLACK, item_rects[i])
+                draw_item(i)
+            pygame.display.update([item_rects[shown], item_rects[selected]])
+        shown = selected
 
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return None
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                shown = None
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_DOWN:
                     selected = (selected + 1) % len(menu_items)
                 if event.key == pygame.K_UP:
                     selected = (selected - 1) % len(menu_items)
                 if event.key == pygame.K_RETURN:
+                    shown = None  # the level (or the prompt) drew over us
                     if selected == 0:
-                        level = read_lvl("level.lvl")
-                        engine = SMBXEngine(level)
-                        engine.run()
+                        play_level("level.lvl")
                     elif selected == 1:
                         # Simple file prompt (you'd use a dialog in real app)
                         print("Enter filename:")
                         filename = sys.stdin.readline().strip()
                         if os.path.exists(filename):
-                            level = read_lvl(filename)
-                            engine = SMBXEngine(level)
-                            engine.run()
+                            play_level(filename)
                     elif selected == 2:
                         return None
         clock.tick(FPS)
@@ -1031,6 +3677,10 @@ def main_menu():
 # ENTRY POINT
 # ========================
 if __name__ == "__main__":
-    main_menu()
+    # python ACHOLDINGSMBX4K.py [level.lvl [replay_out]] - no arguments opens the menu
+    if len(sys.argv) > 1:
+        play_level(sys.argv[1], record_to=sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        main_menu()
     pygame.quit()
     sys.exit()
\ No newline at end of file
@@ -0,0 +1,262 @@
+# AC HOLDINGS CATSAN ENGINE - BENCHMARKS
+# Generates synthetic SMBX .lvl files and measures how parsing, simulation
+# and drawing scale with level size. Results are printed (or written) as JSON
+# so runs from different builds can be diffed.
+#
+#   python smbx_bench.py --blocks 1000,10000,50000 --npcs 50,200 --json out.json
+#
+# A recorded replay is a fixed workload from a real level:
+#
+#   python smbx_bench.py --record run.rpl level.lvl --ticks 3600
+#   python smbx_bench.py --replay run.rpl level.lvl
+
+import os
+import json
+import time
+import struct
+import random
+import argparse
+import platform
+import tempfile
+
+# Benchmarks never need a real window or sound card.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # keep stdout pure JSON
+
+import pygame
+import ACHOLDINGSMBX4K as smbx
+
+# ========================
+# SYNTHETIC LEVEL GENERATOR
+# ========================
+DEFAULT_NPC_MIX = {
+    'goomba': 5, 'koopa_green': 3, 'koopa_red': 2, 'buzzy': 1, 'spiny': 1,
+    'boo': 0.5, 'lakitu': 0.2,
+}
+SOLID_BLOCKS = ['ground', 'brick', 'stone', 'question', 'grass', 'dirt']
+LEVEL_HEIGHT = 20  # tiles
+
+def _pick(rng, mix):
+    names = list(mix)
+    return rng.choices(names, weights=[mix[n] for n in names])[0]
+
+def _section_records(rng, blocks, bgos, npcs, npc_mix, layers):
+    G = smbx.GRID_SIZE
+    # Ground takes one row; everything else is scattered above it, so make the
+    # section wide enough for the requested blocks to fit at ~1/3 density.
+    width = max(64, blocks // 2)
+    floor = min(blocks, width)
+    used = set()
+    block_recs = []
+    for x in range(floor):
+        used.add((x, LEVEL_HEIGHT - 1))
+        block_recs.append((x*G, (LEVEL_HEIGHT-1)*G, smbx.TILE_SMBX_IDS['ground'],
+                           x % layers, 0, 0))
+    while len(block_recs) < blocks:
+        cell = (rng.randrange(width), rng.randrange(4, LEVEL_HEIGHT - 1))
+        if cell in used:
+            continue
+        used.add(cell)
+        name = 'coin' if rng.random() < 0.1 else rng.choice(SOLID_BLOCKS)
+        block_recs.append((cell[0]*G, cell[1]*G, smbx.TILE_SMBX_IDS[name],
+                           rng.randrange(layers), 0, 0))
+    bgo_names = list(smbx.BGO_SMBX_IDS)
+    bgo_recs = [(rng.randrange(width)*G, rng.randrange(LEVEL_HEIGHT-1)*G,
+                 smbx.BGO_SMBX_IDS[rng.choice(bgo_names)], rng.randrange(layers), 0)
+                for _ in range(bgos)]
+    npc_recs = [(rng.randrange(4, width)*G, rng.randrange(2, LEVEL_HEIGHT-2)*G,
+                 smbx.NPC_SMBX_IDS[_pick(rng, npc_mix)], rng.randrange(layers),
+                 0, 0, rng.randrange(2), 0)
+                for _ in range(npcs)]
+    return width * G, LEVEL_HEIGHT * G, block_recs, bgo_recs, npc_recs
+
+def generate_lvl(path, sections=1, blocks=1000, bgos=200, npcs=50,
+                 npc_mix=None, layers=1, seed=0):
+    # Writes a level in the LVL\x1a layout read_lvl() understands. Counts are
+    # per section. Returns the total number of objects written.
+    rng = random.Random(seed)
+    npc_mix = npc_mix or DEFAULT_NPC_MIX
+    layers = max(1, layers)
+    out = bytearray(b'LVL\x1a')
+    out += struct.pack('<I', 64)
+    out += b'Benchmark'.ljust(32, b'\x00') + b'smbx_bench'.ljust(32, b'\x00')
+    out += struct.pack('<III', 300, 0, 0)
+    out += bytes(128 - 4 - 4 - 32 - 32 - 4 - 4 - 4)
+    out += struct.pack('<I', sections)
+    total = 0
+    for _ in range(sections):
+        width, height, block_recs, bgo_recs, npc_recs = _section_records(
+            rng, blocks, bgos, npcs, npc_mix, layers)
+        out += struct.pack('<II', width, height)
+        out += struct.pack('<BBBx', 92, 148, 252)
+        out += struct.pack('<I', 1)
+        out += struct.pack('<I', len(block_recs))
+        out += b''.join(struct.pack('<IIIIII', *r) for r in block_recs)
+        out += struct.pack('<I', len(bgo_recs))
+        out += b''.join(struct.pack('<IIIII', *r) for r in bgo_recs)
+        out += struct.pack('<I', len(npc_recs))
+        out += b''.join(struct.pack('<IIIIIIII', *r) for r in npc_recs)
+        out += struct.pack('<I', 0)  # warps
+        out += struct.pack('<I', 1)  # events
+        name = b'Level - Start'
+        out += struct.pack('<B', len(name)) + name
+        out += struct.pack('<II', 0, 2)
+        out += struct.pack('<III', 1, 0, 0) + struct.pack('<III', 2, 0, 1)
+        total += len(block_recs) + len(bgo_recs) + len(npc_recs)
+    with open(path, 'wb') as f:
+        f.write(out)
+    return total
+
+# ========================
+# BENCHMARKS
+# ========================
+def _best(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+def bench_parse(path, objects, repeat=3):
+    dt, level = _best(lambda: smbx.read_lvl(path), repeat)
+    smbx.read_lvl(path, cache=True)  # compile the sidecar outside the timing
+    cached, _ = _best(lambda: smbx.read_lvl(path, cache=True), repeat)
+    return {'parse_s': dt, 'objects': objects,
+            'objects_per_s': objects / dt if dt else None,
+            'cached_parse_s': cached}, level
+
+def bench_ticks(level, ticks=600):
+    engine = smbx.SMBXEngine(level)
+    script = [smbx.InputState(right=True, jump=(i % 40) < 10) for i in range(ticks)]
+    t = time.perf_counter()
+    done = engine.run_ticks(ticks, smbx.ScriptedInput(script))
+    dt = time.perf_counter() - t
+    return {'ticks': done, 'ticks_per_s': done / dt if dt else None}
+
+def bench_draw(level, frames=120):
+    engine = smbx.SMBXEngine(level)
+    section = engine.section
+    # Pan across the section so chunk baking and culling are both exercised.
+    span = max(1, section.width - smbx.WINDOW_WIDTH)
+    t = time.perf_counter()
+    for i in range(frames):
+        engine.player.rect.centerx = smbx.WINDOW_WIDTH // 2 + span * i // frames
+        engine.camera.update(engine.player)
+        section.activation.update(engine.camera.view())
+        engine.draw()
+    dt = time.perf_counter() - t
+    return {'frames': frames, 'draw_fps': frames / dt if dt else None}
+
+def run_case(case, workdir, repeat=3, ticks=600, frames=120):
+    path = os.path.join(workdir, 'bench_{sections}s_{blocks}b_{bgos}g_{npcs}n_{layers}l.lvl'.format(**case))
+    objects = generate_lvl(path, **case)
+    result = {'case': case, 'file_bytes': os.path.getsize(path)}
+    parsed, level = bench_parse(path, objects, repeat)
+    result.update(parsed)
+    smbx.rng.seed(case.get('seed', 0))
+    result.update(bench_ticks(level, ticks))
+    result.update(bench_draw(smbx.read_lvl(path), frames))
+    return result
+
+STEP_PHASES = ('collections', 'player', 'npcs', 'warps', 'camera', 'activation')
+
+def bench_replay(replay_path, level_path, repeat=3):
+    # Verifies the replay still reproduces tick for tick (ReplayDesync if
+    # not), then times unverified playback with per-phase profiling.
+    replay = smbx.Replay.load(replay_path)
+    smbx.play_replay(replay, level_path)
+
+    def setup(engine):
+        engine.profiler = smbx.FrameProfiler(capacity=max(1, len(replay)))
+        engine.profiler.enabled = True
+
+    dt, engine = _best(lambda: smbx.play_replay(replay, level_path, verify=False,
+                                                engine_setup=setup), repeat)
+    stats = engine.profiler.stats()
+    return {'replay': replay_path, 'level': level_path, 'ticks': len(replay),
+            'ticks_per_s': len(replay) / dt if dt else None,
+            'phases_ms': {p: dict(zip(('avg', 'p95', 'max'), stats[p]))
+                          for p in STEP_PHASES if p in stats}}
+
+def metadata():
+    return {
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def _ints(text):
+    return [int(v) for v in text.split(',') if v]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="SMBX engine benchmarks")
+    ap.add_argument('--sections', default='1', help="comma separated section counts")
+    ap.add_argument('--blocks', default='1000,10000', help="blocks per section")
+    ap.add_argument('--bgos', default='200', help="BGOs per section")
+    ap.add_argument('--npcs', default='50', help="NPCs per section")
+    ap.add_argument('--layers', default='1', help="layers per section")
+    ap.add_argument('--npc-mix', default=None,
+                    help="NPC weights, e.g. goomba=5,koopa_red=1")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--repeat', type=int, default=3, help="parse repetitions (best is kept)")
+    ap.add_argument('--ticks', type=int, default=600)
+    ap.add_argument('--frames', type=int, default=120)
+    ap.add_argument('--json', default=None, help="write results here instead of stdout")
+    ap.add_argument('--record', nargs=2, metavar=('REPLAY', 'LEVEL'),
+                    help="record --ticks of seeded random input on LEVEL and exit")
+    ap.add_argument('--stream', action='store_true',
+                    help="record with wide sections streamed, as the game loads them")
+    ap.add_argument('--replay', nargs=2, metavar=('REPLAY', 'LEVEL'), action='append',
+                    help="benchmark a recorded replay instead of synthetic levels")
+    args = ap.parse_args(argv)
+
+    if args.record:
+        out, level = args.record
+        replay = smbx.record_replay(level, args.ticks, smbx.RandomInput(args.seed), args.seed,
+                                    args.stream)
+        replay.save(out)
+        print(f"recorded {len(replay)} ticks of {level} to {out}")
+        return
+
+    npc_mix = None
+    if args.npc_mix:
+        npc_mix = {}
+        for part in args.npc_mix.split(','):
+            name, _, weight = part.partition('=')
+            if name not in smbx.NPC_SMBX_IDS:
+                ap.error(f"unknown NPC type: {name}")
+            npc_mix[name] = float(weight or 1)
+
+    results = []
+    if args.replay:
+        results = [bench_replay(r, level, args.repeat) for r, level in args.replay]
+        _report(results, args.json)
+        return
+    with tempfile.TemporaryDirectory() as workdir:
+        for sections in _ints(args.sections):
+            for blocks in _ints(args.blocks):
+                for bgos in _ints(args.bgos):
+                    for npcs in _ints(args.npcs):
+                        for layers in _ints(args.layers):
+                            case = {'sections': sections, 'blocks': blocks, 'bgos': bgos,
+                                    'npcs': npcs, 'layers': layers, 'npc_mix': npc_mix,
+                                    'seed': args.seed}
+                            results.append(run_case(case, workdir, args.repeat,
+                                                    args.ticks, args.frames))
+    _report(results, args.json)
+
+def _report(results, path):
+    report = json.dumps({'meta': metadata(), 'results': results}, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# AC HOLDINGS CATSAN ENGINE - HEADLESS LEVEL CHECKER
+# Loads .lvl files through read_lvl() and plays each one headless for a fixed
+# number of ticks, spread over every core with a process pool. Per-level load
+# time, ticks/sec, peak object counts, deaths and errors come out as JSON;
+# the exit status is 1 if any level failed to parse or crashed.
+#
+#   python smbx_check.py levels/ --ticks 3600 --input random --json report.json
+
+import os
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# The engine opens no window or audio device unless something is drawn or
+# played, so workers run on machines that have neither.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # keep stdout pure JSON
+
+import ACHOLDINGSMBX4K as smbx
+
+INPUT_MODES = ('idle', 'right', 'random')
+
+def make_input(mode, seed, ticks):
+    if mode == 'random':
+        return smbx.RandomInput(seed)
+    if mode == 'right':
+        # Run right, hopping every 40 ticks, like the benchmarks do.
+        return smbx.ScriptedInput(smbx.InputState(right=True, jump=(i % 40) < 10)
+                                  for i in range(ticks))
+    return None
+
+def find_levels(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                found.extend(os.path.join(root, f) for f in files
+                             if f.lower().endswith('.lvl'))
+        else:
+            found.append(path)
+    return sorted(found)
+
+def count_objects(level):
+    tiles = bgos = npcs = 0
+    for section in level.sections:
+        for layer in section.layers:
+            tiles += len(layer.tiles)
+            bgos += len(layer.bgos)
+            npcs += len(layer.npcs)
+    return {'tiles': tiles, 'bgos': bgos, 'npcs': npcs}
+
+def check_level(path, ticks=600, input_mode='right', seed=0, cache=False, stream=False):
+    result = {'path': path, 'ok': False, 'error': None}
+    t = time.perf_counter()
+    try:
+        level = smbx.read_lvl(path, cache=cache, stream=stream)
+        result['load_s'] = time.perf_counter() - t
+        result['sections'] = len(level.sections)
+        result['objects'] = count_objects(level)
+    except (OSError, smbx.LevelFormatError) as e:
+        result['error'] = {'kind': 'parse', 'type': type(e).__name__, 'message': str(e)}
+        return result
+    except Exception as e:
+        # A loader bug on one file must not take the whole run down with it.
+        result['error'] = {'kind': 'crash', 'type': type(e).__name__, 'message': str(e),
+                           'tick': None, 'traceback': traceback.format_exc()}
+        return result
+
+    smbx.rng.seed(seed)
+    source = make_input(input_mode, seed, ticks)
+    idle = smbx.InputState()
+    done = deaths = 0
+    game_over = False
+    peak_npcs = peak_active = peak_fireballs = 0
+    t = time.perf_counter()
+    try:
+        engine = smbx.SMBXEngine(level)
+        player = engine.player
+        was_dead = False
+        while done < ticks and not engine.game_over:
+            engine.step(source.poll(engine.tick) if source else idle)
+            done += 1
+            if player.dead and not was_dead:
+                deaths += 1
+            was_dead = player.dead
+            section = engine.section
+            peak_npcs = max(peak_npcs, len(section.get_all_npcs()))
+            peak_active = max(peak_active, len(section.activation.active_list()))
+            peak_fireballs = max(peak_fireballs, len(player.fireballs))
+        game_over = engine.game_over
+    except Exception as e:
+        result['error'] = {'kind': 'crash', 'type': type(e).__name__, 'message': str(e),
+                           'tick': done, 'traceback': traceback.format_exc()}
+    dt = time.perf_counter() - t
+    result.update({
+        'ticks': done,
+        'ticks_per_s': done / dt if dt else None,
+        'deaths': deaths,
+        'game_over': game_over,
+        'peak': {'npcs': peak_npcs, 'active_npcs': peak_active, 'fireballs': peak_fireballs},
+    })
+    result['ok'] = result['error'] is None
+    return result
+
+def _check(job):
+    return check_level(*job)
+
+def run_checks(paths, ticks=600, input_mode='right', seed=0, workers=None, cache=False,
+               stream=False):
+    jobs = [(path, ticks, input_mode, seed, cache, stream) for path in paths]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        return [_check(job) for job in jobs]
+    # Levels are small, uneven jobs: hand them out in modest chunks so one
+    # slow level doesn't hold up a whole batch.
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_check, jobs, chunksize=chunksize))
+
+def summarize(results, wall_s):
+    ok = [r for r in results if r['ok']]
+    return {
+        'levels': len(results),
+        'ok': len(ok),
+        'parse_errors': sum(1 for r in results if r['error'] and r['error']['kind'] == 'parse'),
+        'crashes': sum(1 for r in results if r['error'] and r['error']['kind'] == 'crash'),
+        'deaths': sum(r.get('deaths', 0) for r in results),
+        'wall_s': wall_s,
+        'levels_per_s': len(results) / wall_s if wall_s else None,
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Play SMBX levels headless and report problems")
+    ap.add_argument('paths', nargs='+', help=".lvl files or directories to search")
+    ap.add_argument('--ticks', type=int, default=600, help="ticks to run each level for")
+    ap.add_argument('--input', choices=INPUT_MODES, default='right')
+    ap.add_argument('--seed', type=int, default=0, help="seed for random input and NPC AI")
+    ap.add_argument('--workers', type=int, default=None, help="processes (default: all cores)")
+    ap.add_argument('--json', default=None, help="write the report here instead of stdout")
+    ap.add_argument('--cache', action='store_true',
+                    help="load through (and write) each level's compiled .lvlc sidecar")
+    ap.add_argument('--stream', action='store_true',
+                    help="stream very wide sections around the camera instead of building them whole")
+    args = ap.parse_args(argv)
+
+    paths = find_levels(args.paths)
+    t = time.perf_counter()
+    results = run_checks(paths, args.ticks, args.input, args.seed, args.workers, args.cache,
+                         args.stream)
+    report = {'summary': summarize(results, time.perf_counter() - t), 'results': results}
+    text = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0 if all(r['ok'] for r in results) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
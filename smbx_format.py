@@ -0,0 +1,199 @@
+# AC HOLDINGS CATSAN ENGINE - LEVEL FORMAT
+# SMBX ID tables and the LVL\x1a binary layout: record structs, a bounds-
+# checked reader and the section parsers. Nothing here imports pygame, so
+# tools that only inspect levels load in milliseconds. ACHOLDINGSMBX4K
+# re-exports all of it and builds playable levels on top.
+
+import struct
+from array import array
+from collections import namedtuple
+
+# ========================
+# SMBX ID MAPPINGS (full)
+# ========================
+TILE_SMBX_IDS = {
+    'ground':1, 'grass':2, 'sand':3, 'dirt':4,
+    'brick':45, 'question':34, 'pipe_vertical':112, 'pipe_horizontal':113,
+    'platform':159, 'coin':10, 'bridge':47,
+    'stone':48, 'ice':55, 'mushroom_platform':91, 'pswitch':60,
+    'slope_left':182, 'slope_right':183, 'water':196, 'lava':197,
+    'conveyor_left':188, 'conveyor_right':189, 'semisolid':190,
+    'crate':191, 'switchblock':192, 'vine':193,
+}
+BGO_SMBX_IDS = {
+    'cloud':5, 'bush':6, 'hill':7, 'fence':8, 'bush_3':9, 'tree':10,
+    'castle':11, 'waterfall':12, 'sign':13, 'fence2':14, 'fence3':15,
+    'window':16, 'fence4':17, 'fence5':18,
+}
+NPC_SMBX_IDS = {
+    'goomba':1, 'koopa_green':2, 'koopa_red':3, 'paratroopa_green':4,
+    'paratroopa_red':5, 'piranha':6, 'hammer_bro':7, 'lakitu':8,
+    'mushroom':9, 'flower':10, 'star':11, '1up':12,
+    'buzzy':13, 'spiny':14, 'cheep':15, 'blooper':16, 'thwomp':17, 'bowser':18,
+    'boo':19, 'podoboo':20, 'piranha_fire':21, 'sledge_bro':22, 'rotodisc':23,
+    'burner':24, 'cannon':25, 'bullet_bill':26, 'bowser_statue':27,
+    'grinder':28, 'fishbone':29, 'dry_bones':30, 'boo_ring':31,
+    'bomber_bill':32, 'bony_beetle':33, 'skull_platform':34,
+    'birdo':35, 'egg':36, 'shell':37,
+}
+TILE_ID_TO_NAME = {v:k for k,v in TILE_SMBX_IDS.items()}
+BGO_ID_TO_NAME  = {v:k for k,v in BGO_SMBX_IDS.items()}
+NPC_ID_TO_NAME  = {v:k for k,v in NPC_SMBX_IDS.items()}
+
+# ========================
+# LVL\x1a FILES
+# ========================
+class LevelFormatError(ValueError):
+    pass
+
+# Record layouts of the LVL\x1a format, compiled once.
+LVL_HEADER = struct.Struct('<4sI32s32sIII')  # magic, version, name, author, time, stars, flags
+LVL_HEADER_SIZE = 128
+U8 = struct.Struct('<B')
+U32 = struct.Struct('<I')
+SECTION_HEADER = struct.Struct('<IIBBBxI')  # width, height, bg r/g/b, pad, music
+BLOCK_RECORD = struct.Struct('<IIIIII')     # x, y, type, layer, event, flags
+BGO_RECORD = struct.Struct('<IIIII')        # x, y, type, layer, flags
+NPC_RECORD = struct.Struct('<IIIIIIII')     # x, y, type, layer, event, flags, direction, special
+WARP_RECORD_SIZE = 64
+EVENT_HEADER = struct.Struct('<II')         # trigger, action count
+EVENT_ACTION = struct.Struct('<III')        # type, target, value
+MAX_LAYERS = 256
+
+RawSection = namedtuple('RawSection', 'width height bg_color music blocks bgos npcs warps events')
+SectionIndex = namedtuple('SectionIndex', 'offset width height blocks bgos npcs warps events')
+
+class LvlReader:
+    # Cursor over an in-memory level file. Every read is bounds-checked first,
+    # so a short file fails with the offset and what was being read.
+    def __init__(self, data):
+        self.buf = memoryview(data)
+        self.pos = 0
+
+    def need(self, size, what):
+        if self.pos + size > len(self.buf):
+            raise LevelFormatError(
+                f"truncated level file: {what} needs {size} bytes at offset "
+                f"{self.pos}, only {len(self.buf) - self.pos} left")
+
+    def unpack(self, st, what):
+        self.need(st.size, what)
+        values = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return values
+
+    def count(self, what):
+        return self.unpack(U32, what + " count")[0]
+
+    def table(self, st, what):
+        # A u32 count followed by that many fixed-size records, decoded in bulk.
+        n = self.count(what)
+        size = n * st.size
+        self.need(size, f"{n} {what} records")
+        records = list(st.iter_unpack(self.buf[self.pos:self.pos + size]))
+        self.pos += size
+        return records
+
+    def skip(self, size, what):
+        self.need(size, what)
+        self.pos += size
+
+    def skip_table(self, record_size, what):
+        n = self.count(what)
+        self.skip(n * record_size, f"{n} {what} records")
+        return n
+
+    def bytes(self, size, what):
+        self.need(size, what)
+        data = bytes(self.buf[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def column(self, typecode, n, what):
+        # n native-order array items copied straight out of the buffer.
+        values = array(typecode)
+        size = n * values.itemsize
+        self.need(size, f"{n} {what}")
+        values.frombytes(self.buf[self.pos:self.pos + size])
+        self.pos += size
+        return values
+
+def parse_lvl_header(reader, level):
+    start = reader.pos
+    magic, version, name, author, time_limit, stars, flags = reader.unpack(LVL_HEADER, "header")
+    if magic != b'LVL\x1a':
+        raise LevelFormatError("not an SMBX level file (bad magic)")
+    level.name = name.decode('utf-8', errors='ignore').strip('\x00')
+    level.author = author.decode('utf-8', errors='ignore').strip('\x00')
+    level.time_limit = time_limit
+    level.stars = stars
+    level.no_background = bool(flags & 1)
+    reader.need(LVL_HEADER_SIZE - LVL_HEADER.size, "header padding")
+    reader.pos = start + LVL_HEADER_SIZE
+    return version
+
+def parse_section(reader):
+    width, height, bg_r, bg_g, bg_b, music = reader.unpack(SECTION_HEADER, "section header")
+    blocks = reader.table(BLOCK_RECORD, "block")
+    bgos = reader.table(BGO_RECORD, "BGO")
+    npcs = reader.table(NPC_RECORD, "NPC")
+    warps = reader.skip_table(WARP_RECORD_SIZE, "warp")  # not interpreted yet
+    events = parse_events(reader)
+    return RawSection(width, height, (bg_r, bg_g, bg_b), music, blocks, bgos, npcs, warps, events)
+
+def parse_events(reader):
+    events = []
+    for _ in range(reader.count("event")):
+        name_len = reader.unpack(U8, "event name length")[0]
+        name = reader.bytes(name_len, "event name").decode('utf-8', errors='replace')
+        trigger, action_count = reader.unpack(EVENT_HEADER, "event header")
+        size = action_count * EVENT_ACTION.size
+        reader.need(size, f"{action_count} event actions")
+        actions = list(EVENT_ACTION.iter_unpack(reader.buf[reader.pos:reader.pos + size]))
+        reader.pos += size
+        events.append((name, trigger, actions))
+    return events
+
+def encode_events(events):
+    out = bytearray(U32.pack(len(events)))
+    for name, trigger, actions in events:
+        name = name.encode('utf-8')[:255]
+        out += U8.pack(len(name)) + name + EVENT_HEADER.pack(trigger, len(actions))
+        out += b''.join(EVENT_ACTION.pack(*action) for action in actions)
+    return out
+
+def index_section(reader):
+    # Cheap pass over one section: remember where it starts and how big its
+    # tables are, checking bounds but decoding no records.
+    offset = reader.pos
+    width, height = reader.unpack(SECTION_HEADER, "section header")[:2]
+    blocks = reader.skip_table(BLOCK_RECORD.size, "block")
+    bgos = reader.skip_table(BGO_RECORD.size, "BGO")
+    npcs = reader.skip_table(NPC_RECORD.size, "NPC")
+    warps = reader.skip_table(WARP_RECORD_SIZE, "warp")
+    events = reader.count("event")
+    for _ in range(events):
+        reader.skip(reader.unpack(U8, "event name length")[0], "event name")
+        action_count = reader.unpack(EVENT_HEADER, "event header")[1]
+        reader.skip(action_count * EVENT_ACTION.size, f"{action_count} event actions")
+    return SectionIndex(offset, width, height, blocks, bgos, npcs, warps, events)
+
+def check_layer(idx):
+    if idx >= MAX_LAYERS:
+        raise LevelFormatError(f"layer index {idx} out of range")
+    return idx
+
+class LevelInfo:
+    # Header fields of a level, filled in by parse_lvl_header() for tools that
+    # have no use for a full Level.
+    __slots__ = ('name', 'author', 'time_limit', 'stars', 'no_background')
+
+def read_raw_lvl(filename):
+    # Header and fully decoded record tables of a level, without building any
+    # game objects. Raises OSError or LevelFormatError like read_lvl().
+    with open(filename, 'rb') as f:
+        data = f.read()
+    reader = LvlReader(data)
+    info = LevelInfo()
+    parse_lvl_header(reader, info)
+    return info, [parse_section(reader) for _ in range(reader.count("section"))]
@@ -0,0 +1,309 @@
+# AC HOLDINGS CATSAN ENGINE - HEADLESS REGRESSION CHECKS
+# Runs the engine's fast paths against their reference paths on generated
+# levels (and any .lvl files given) and fails if they ever disagree. Every
+# comparison is tick by tick on state checksums, so the first differing tick
+# is reported. Exit status is 1 if any check failed.
+#
+#   python smbx_regress.py
+#   python smbx_regress.py --checks walkers --ticks 3000 levels/
+
+import os
+import sys
+import struct
+import shutil
+import argparse
+import tempfile
+import traceback
+from array import array
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import ACHOLDINGSMBX4K as smbx
+from smbx_bench import generate_lvl
+from smbx_check import find_levels
+
+WALKER_MIX = {'goomba': 3, 'koopa_green': 1, 'koopa_red': 1, 'buzzy': 1, 'spiny': 1}
+
+# ========================
+# LEVELS
+# ========================
+def _first_block_offset():
+    # Offset of section 0's first block record in a generate_lvl() file.
+    return (smbx.LVL_HEADER_SIZE + smbx.U32.size + smbx.SECTION_HEADER.size
+            + smbx.U32.size)
+
+def make_levels(workdir):
+    # name -> path of the generated levels every check runs on.
+    levels = {}
+    def gen(name, **kw):
+        path = levels[name] = os.path.join(workdir, name + '.lvl')
+        generate_lvl(path, **kw)
+        return path
+    # Narrow and crowded: enough walkers awake at once for the numpy batch.
+    gen('crowd', blocks=100, npcs=150, npc_mix=WALKER_MIX, seed=1)
+    gen('mixed', sections=2, blocks=3000, bgos=300, npcs=120, layers=2, seed=2)
+    # LVL coordinates are u32; put a few blocks far past the section.
+    path = gen('far', blocks=100, npcs=150, npc_mix=WALKER_MIX, seed=3)
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        offset = _first_block_offset()
+        for i, (x, y) in enumerate(((2**31 + 64, 128), (64, 2**32 - 32), (2**32 - 32, 2**31))):
+            struct.pack_into('<II', data, offset + 10 * i * smbx.BLOCK_RECORD.size, x, y)
+        f.seek(0)
+        f.write(data)
+    # Wide enough that read_lvl(stream=True) streams it.
+    gen('wide', blocks=12000, bgos=600, npcs=600, layers=2, seed=4)
+    return levels
+
+def has_wide_section(path):
+    with open(path, 'rb') as f:
+        reader = smbx.LvlReader(f.read())
+    smbx.parse_lvl_header(reader, smbx.LevelInfo())
+    return any(smbx.index_section(reader).width >= smbx.STREAM_MIN_WIDTH
+               for _ in range(reader.count("section")))
+
+# ========================
+# RUNS
+# ========================
+def make_input(kind, seed, ticks):
+    if kind == 'random':
+        return smbx.RandomInput(seed)
+    return smbx.ScriptedInput(smbx.InputState(right=True, jump=(i % 40) < 10)
+                              for i in range(ticks))
+
+RUNS = (('right', 0), ('random', 1))
+
+def trace(level, ticks, kind, seed, setup=None):
+    # State checksum after every tick of one seeded run.
+    smbx.rng.seed(seed)
+    engine = smbx.SMBXEngine(level)
+    if setup:
+        setup(engine)
+    source = make_input(kind, seed, ticks)
+    sums = array('I')
+    while engine.tick < ticks and not engine.game_over:
+        engine.step(source.poll(engine.tick))
+        sums.append(engine.state_checksum())
+    return sums
+
+def expect_same(a, b, what):
+    # Raises AssertionError naming the first tick where two traces differ.
+    for tick, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            raise AssertionError(f"{what}: first difference at tick {tick}")
+    if len(a) != len(b):
+        raise AssertionError(f"{what}: runs ended at ticks {len(a)} and {len(b)}")
+
+# ========================
+# CHECKS
+# ========================
+class Skip(Exception):
+    pass
+
+def check_walkers(path, ticks):
+    # Batched walker physics against NPC.update() for every walker.
+    if smbx.np is None:
+        raise Skip("numpy not installed")
+    batched = [0]
+    def per_object(engine):
+        engine.walkers = None
+    def counted(engine):
+        step = engine.walkers._step
+        def counting(*args):
+            batched[0] += 1
+            return step(*args)
+        engine.walkers._step = counting
+    for kind, seed in RUNS:
+        expect_same(trace(smbx.read_lvl(path), ticks, kind, seed, per_object),
+                    trace(smbx.read_lvl(path), ticks, kind, seed, counted), f"{kind} input")
+    return f"{batched[0]} batched steps"
+
+def _replay_fields(replay):
+    return (replay.level_name, replay.level_crc, replay.seed, bytes(replay.inputs),
+            replay.checksums.tobytes())
+
+def check_replay(path, ticks):
+    # record_replay() -> save() -> Replay.load() -> play_replay() reproduces
+    # every tick's checksum, streamed too if the level has a wide section.
+    recorded = 0
+    modes = (False, True) if has_wide_section(path) else (False,)
+    with tempfile.TemporaryDirectory() as workdir:
+        out = os.path.join(workdir, 'run.rpl')
+        for stream in modes:
+            for seed in (0, 1):
+                what = f"seed {seed}{' streamed' if stream else ''}"
+                replay = smbx.record_replay(path, ticks, smbx.RandomInput(seed), seed, stream)
+                replay.save(out)
+                loaded = smbx.Replay.load(out)
+                assert (_replay_fields(loaded) == _replay_fields(replay)
+                        and loaded.stream == stream), f"{what}: changed by save/load"
+                try:
+                    smbx.play_replay(loaded, path)
+                except smbx.ReplayDesync as e:
+                    raise AssertionError(f"{what}: {e}") from None
+                recorded += len(replay)
+    return f"{recorded} ticks replayed"
+
+def dump_level(level):
+    # Everything read_lvl() builds, as plain comparable values.
+    out = [level.name, level.author, level.time_limit, level.stars, level.no_background]
+    for section in level.sections:
+        out.append((section.width, section.height, section.bg_color, section.music,
+                    [(e.name, e.trigger, e.actions) for e in section.events]))
+        for layer in section.layers:
+            store = layer.tiles
+            out.append((layer.name, layer.visible, store.live,
+                        [col.tobytes() for col in (store.xs, store.ys, store.types, store.events,
+                                                   store.flags, store.state)],
+                        sorted((key, list(rows)) for key, rows in store.buckets.items()),
+                        sorted((kind, sorted((key, list(rows)) for key, rows in buckets.items()))
+                               for kind, buckets in store.kinds.items())))
+            out.append([(b.rect.topleft, b.bgo_type, b.flags) for b in layer.bgos])
+            out.append([(n.rect.topleft, n.npc_type, n.event_id, n.flags, n.direction,
+                         n.special_data) for n in layer.npcs])
+    return out
+
+def check_cache(path, ticks):
+    # read_lvl(cache=True) against decoding the level itself: compiling the
+    # .lvlc, loading it warm, lazily and mapped, after the source's mtime
+    # changes and after the cache is damaged. Works on a copy, so no .lvlc
+    # is left next to the given level.
+    with tempfile.TemporaryDirectory() as workdir:
+        level_path = os.path.join(workdir, os.path.basename(path))
+        shutil.copyfile(path, level_path)
+        ref = dump_level(smbx.read_lvl(level_path))
+        def same(what, **kw):
+            assert dump_level(smbx.read_lvl(level_path, cache=True, **kw)) == ref, what
+        same("compiling")
+        same("warm cache")
+        same("lazy", lazy=True)
+        same("lazy, mapped", lazy=True, use_mmap=True)
+        st = os.stat(level_path)
+        os.utime(level_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        same("source touched")
+        with open(smbx.cache_path(level_path), 'rb') as f:
+            header = smbx.CACHE_HEADER.unpack(f.read(smbx.CACHE_HEADER.size))
+        assert header[4] == st.st_mtime_ns + 10**9, "new mtime not written back"
+        with open(smbx.cache_path(level_path), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes((last[0] ^ 0xff,)))
+        same("damaged cache")
+        assert smbx.open_cache(level_path, os.stat(level_path)) is not None, "damaged cache not rebuilt"
+        for kind, seed in RUNS:
+            expect_same(trace(smbx.read_lvl(level_path), ticks, kind, seed),
+                        trace(smbx.read_lvl(level_path, lazy=True, cache=True), ticks, kind, seed),
+                        f"{kind} input")
+    return None
+
+def tour(level, seed=0):
+    # Checksums from dropping the player along a wide section and back, with
+    # a tile broken, a tile retyped and an NPC killed near the start so
+    # eviction has something to remember; then what is live in that chunk.
+    smbx.rng.seed(seed)
+    engine = smbx.SMBXEngine(level)
+    section = engine.section
+    idle = smbx.InputState()
+    sums = array('I')
+    def goto(x):
+        engine.player.rect.topleft = (x, 0)
+        engine.player.velocity.update(0, 0)
+        for _ in range(3):
+            engine.step(idle)
+            sums.append(engine.state_checksum())
+    start, end = 3 * smbx.STREAM_CHUNK, 4 * smbx.STREAM_CHUNK
+    goto(start)
+    rows = sorted((store.xs[row], store.ys[row], i, row)
+                  for i, layer in enumerate(section.layers) for store in [layer.tiles]
+                  for row in store.rows_near(start, 0, end, section.height))
+    if len(rows) >= 2:
+        section.layers[rows[0][2]].tiles.remove_row(rows[0][3])
+        section.layers[rows[1][2]].tiles.set_type(rows[1][3], smbx.TILE_SMBX_IDS['stone'])
+    npcs = sorted((npc.spawn, npc) for npc in section.activation.active_list()
+                  if npc.spawn is not None)
+    if npcs:
+        npcs[0][1].kill()
+    far = section.width - smbx.WINDOW_WIDTH
+    for x in list(range(start, far, 2 * smbx.STREAM_CHUNK)) + [far, start]:
+        goto(x)
+    tiles = sorted((store.xs[row], store.ys[row], store.types[row])
+                   for layer in section.layers for store in [layer.tiles]
+                   for row in store.rows_near(start, 0, end, section.height))
+    placed = sorted((npc.spawn, npc.dead) for layer in section.layers for npc in layer.npcs
+                    if npc.spawn is not None and start <= npc.spawn[0] < end)
+    return sums, tiles, placed
+
+def check_stream(path, ticks):
+    # Streaming a wide section around the camera against building it whole:
+    # seeded runs, then a tour far along the section and back.
+    if not has_wide_section(path):
+        raise Skip("no section wide enough to stream")
+    for kind, seed in RUNS + (('random', 2),):
+        expect_same(trace(smbx.read_lvl(path, lazy=True), ticks, kind, seed),
+                    trace(smbx.read_lvl(path, lazy=True, stream=True), ticks, kind, seed),
+                    f"{kind} input, seed {seed}")
+    whole = tour(smbx.read_lvl(path, lazy=True))
+    streamed = tour(smbx.read_lvl(path, lazy=True, stream=True))
+    expect_same(whole[0], streamed[0], "tour")
+    assert whole[1] == streamed[1], "tour: tiles differ after coming back"
+    assert whole[2] == streamed[2], "tour: NPCs differ after coming back"
+    return None
+
+CHECKS = {
+    'walkers': check_walkers,
+    'replay': check_replay,
+    'cache': check_cache,
+    'stream': check_stream,
+}
+
+def run_checks(checks, paths, ticks):
+    # Yields (check, level path, status, detail) with status 'ok', 'FAIL' or
+    # 'skip'.
+    unreadable = {}
+    for path in paths:
+        try:
+            smbx.read_lvl(path)
+        except (OSError, smbx.LevelFormatError) as e:
+            unreadable[path] = f"does not load: {e}"
+    for name in checks:
+        for path in paths:
+            if path in unreadable:
+                yield name, path, 'skip', unreadable[path]
+                continue
+            try:
+                status, detail = 'ok', CHECKS[name](path, ticks)
+            except Skip as e:
+                status, detail = 'skip', str(e)
+            except AssertionError as e:
+                status, detail = 'FAIL', str(e)
+            except Exception:
+                status, detail = 'FAIL', traceback.format_exc()
+            yield name, path, status, detail
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Check the engine's fast paths against its reference paths")
+    ap.add_argument('paths', nargs='*', help=".lvl files or directories to check as well")
+    ap.add_argument('--checks', default=','.join(CHECKS),
+                    help="comma separated checks to run (default: all)")
+    ap.add_argument('--ticks', type=int, default=600, help="ticks per run")
+    args = ap.parse_args(argv)
+    checks = [c for c in args.checks.split(',') if c]
+    for c in checks:
+        if c not in CHECKS:
+            ap.error(f"unknown check: {c} (have {', '.join(CHECKS)})")
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = list(make_levels(workdir).values()) + find_levels(args.paths)
+        for name, path, status, detail in run_checks(checks, paths, args.ticks):
+            failed += status == 'FAIL'
+            print(f"{status:<5}{name:<9}{os.path.basename(path)}" + (f"  {detail}" if detail else ""))
+            sys.stdout.flush()
+    print("failed:", failed if failed else "none")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())